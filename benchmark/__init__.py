@@ -0,0 +1,2 @@
+# Offline throughput benchmark: serves recorded or synthetic API fixtures from a local stand-in
+# server and runs the spiders against it, see benchmark/run.py
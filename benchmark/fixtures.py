@@ -0,0 +1,80 @@
+import json
+import random
+from datetime import datetime, timedelta, timezone
+
+# a handful of Japanese snippets, so translation batches see realistic token counts
+TITLES = ['サイズ感がちょうどいい', '色がきれい', '少し小さめでした', 'リピートしています', '生地が薄い']
+COMMENTS = [
+    '普段Mサイズですが、Lサイズでちょうど良かったです。洗濯しても縮みませんでした。',
+    '色違いで購入しました。シンプルなデザインで使いやすいです。',
+    '生地がしっかりしていて、値段以上の品質だと思います。',
+    '丈が少し短く感じましたが、全体的には満足しています。',
+    '肌触りが良く、毎日のように着ています。また買いたいです。',
+]
+
+
+def generate_fixtures(products=200, reviews_per_product=40, seed=0):
+    """
+    Build a synthetic catalogue in the shape of the Uniqlo API responses
+    :param products: number of products in the listing
+    :param reviews_per_product: average number of reviews per product
+    :param seed: random seed, the same seed always gives the same fixtures
+    :return: dict with 'products' (raw listing items) and 'reviews' (product_id -> raw reviews, newest first)
+    """
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    fixtures = {'products': [], 'reviews': {}}
+    review_id = 1
+    for index in range(products):
+        product_id = f'E{460000 + index}-000'
+        review_count = rng.randint(0, 2 * reviews_per_product)
+        reviews = []
+        for _ in range(review_count):
+            created = start + timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+            reviews.append({
+                'reviewId': review_id,
+                'purchasedSize': rng.choice(['S', 'M', 'L', 'XL']),
+                'comment': rng.choice(COMMENTS),
+                'fit': rng.randint(1, 5),
+                'gender': rng.choice(['男性', '女性']),
+                'location': rng.choice(['東京都', '大阪府', '北海道']),
+                'name': f'user{rng.randint(1, 99999)}',
+                'rate': rng.randint(1, 5),
+                'title': rng.choice(TITLES),
+                'createDate': created.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            })
+            review_id += 1
+        # the endpoint is queried with sort=submission_time, newest first
+        reviews.sort(key=lambda review: review['createDate'], reverse=True)
+        base_price = rng.choice([990, 1990, 2990, 3990])
+        fixtures['products'].append({
+            'productId': product_id,
+            'name': f'Benchmark product {index}',
+            'prices': {
+                'base': {'value': base_price},
+                'promo': {'value': base_price - 500} if rng.random() < 0.2 else None,
+            },
+            'colors': [{'name': name} for name in rng.sample(['WHITE', 'BLACK', 'NAVY', 'GRAY'], 2)],
+            'rating': {
+                'average': round(sum(review['rate'] for review in reviews) / len(reviews), 1) if reviews else 0,
+                'count': len(reviews),
+            },
+            'images': {'main': {'00': {'image': f'https://image.example/{product_id}.jpg'}}},
+        })
+        fixtures['reviews'][product_id] = reviews
+    return fixtures
+
+
+def load_fixtures(path):
+    """
+    Load fixtures saved with save_fixtures, or recorded by hand from the real API in the same shape
+    :param path: path of the JSON file
+    :return: fixtures dict, see generate_fixtures
+    """
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_fixtures(fixtures, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(fixtures, f, ensure_ascii=False)
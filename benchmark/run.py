@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is then not reported
+    resource = None
+
+from pymongo import MongoClient
+
+from ..launcher import project_settings, spider_classes
+from .fixtures import generate_fixtures, load_fixtures, save_fixtures
+from .server import API_PREFIX, start_server
+
+
+class ThroughputRecorder:
+    """
+    Collect the numbers of one crawl from the crawler signals: item latency is the time from the
+    response that produced an item to the item leaving the last pipeline
+    """
+
+    def __init__(self, crawler):
+        from scrapy import signals
+        self.crawler = crawler
+        self.latencies = []
+        self.started = None
+        self.finished = None
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.response_received, signal=signals.response_received)
+        crawler.signals.connect(self.item_scraped, signal=signals.item_scraped)
+
+    def spider_opened(self, spider):
+        self.started = time.perf_counter()
+
+    def spider_closed(self, spider):
+        self.finished = time.perf_counter()
+
+    def response_received(self, response, request, spider):
+        request.meta['benchmark_received'] = time.perf_counter()
+
+    def item_scraped(self, item, response, spider):
+        received = response.meta.get('benchmark_received') if response is not None else None
+        if received is not None:
+            self.latencies.append(time.perf_counter() - received)
+
+    def results(self):
+        stats = self.crawler.stats
+        elapsed = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        items = stats.get_value('item_scraped_count', 0)
+        requests = stats.get_value('downloader/request_count', 0)
+        return {
+            'spider': self.crawler.spider.name,
+            'elapsed_s': round(elapsed, 3),
+            'items': items,
+            'requests': requests,
+            'items_per_s': round(items / elapsed, 1) if elapsed else 0,
+            'requests_per_s': round(requests / elapsed, 1) if elapsed else 0,
+            'p50_item_latency_ms': round(percentile(self.latencies, 50) * 1000, 1),
+            'p99_item_latency_ms': round(percentile(self.latencies, 99) * 1000, 1),
+            # peak of the whole process so far, so it includes the spiders that ran before
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_settings(base_url, args):
+    settings = project_settings({
+        'UNIQLO_API_BASE_URL': base_url + API_PREFIX,
+        # every run has to reach the stand-in server, a warm cache would measure nothing
+        'HTTPCACHE_ENABLED': False,
+        'LOG_LEVEL': args.log_level,
+        # the fake backend has no quota, keep the limiter out of the numbers unless asked for
+        'OPENAI_REQUESTS_PER_MINUTE': args.openai_rpm,
+        'OPENAI_TOKENS_PER_MINUTE': args.openai_tpm,
+        'OPENAI_RATE_LIMIT_FILE': None,
+    })
+    for setting in args.set:
+        name, _, value = setting.partition('=')
+        settings.set(name, value, priority='cmdline')
+    return settings
+
+
+def run_spiders(settings, spider_names, host):
+    from scrapy.utils.reactor import install_reactor
+    install_reactor(settings['TWISTED_REACTOR'])
+    from twisted.internet import defer, reactor
+    from scrapy.crawler import CrawlerRunner
+
+    spiders = spider_classes()
+    runner = CrawlerRunner(settings)
+    results = []
+
+    @defer.inlineCallbacks
+    def crawl():
+        try:
+            # one after the other: reviewSpider plans its crawl from the products productSpider stored
+            for name in spider_names:
+                crawler = runner.create_crawler(spiders[name])
+                recorder = ThroughputRecorder(crawler)
+                yield runner.crawl(crawler, allowed_domains=[host])
+                results.append(recorder.results())
+        finally:
+            reactor.stop()
+
+    crawl()
+    reactor.run()
+    return results
+
+
+def print_results(results):
+    columns = ['spider', 'elapsed_s', 'items', 'requests', 'items_per_s', 'requests_per_s',
+               'p50_item_latency_ms', 'p99_item_latency_ms', 'peak_rss_mb']
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline throughput benchmark of productSpider and reviewSpider')
+    parser.add_argument('--fixtures', help='JSON fixtures to serve instead of generating them')
+    parser.add_argument('--save-fixtures', help='write the generated fixtures to this file and exit')
+    parser.add_argument('--products', type=int, default=200, help='generated products')
+    parser.add_argument('--reviews-per-product', type=int, default=40, help='average generated reviews per product')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per API response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +/- seconds added to every latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API requests answered with 503')
+    parser.add_argument('--max-page-size', type=int, default=100, help='largest review page the stand-in honours')
+    parser.add_argument('--translation-latency', type=float, default=0.5, help='seconds per translation request')
+    parser.add_argument('--translation-error-rate', type=float, default=0.0,
+                        help='share of translation requests answered with 429')
+    parser.add_argument('--openai-rpm', type=int, default=100000)
+    parser.add_argument('--openai-tpm', type=int, default=100000000)
+    parser.add_argument('--spiders', nargs='+', default=['productSpider', 'reviewSpider'],
+                        choices=['productSpider', 'reviewSpider'])
+    parser.add_argument('--mongo-url', default=os.getenv('MONGO_URL', 'mongodb://localhost:27017'),
+                        help='a local mongod; the benchmark database is dropped before each run')
+    parser.add_argument('--mongo-db', default='uniqlo_benchmark')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a Scrapy setting, e.g. --set REVIEW_PAGE_SIZE=20')
+    parser.add_argument('--output', help='append the results as one JSON line to this file')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures) if args.fixtures else \
+        generate_fixtures(args.products, args.reviews_per_product, args.seed)
+    if args.save_fixtures:
+        save_fixtures(fixtures, args.save_fixtures)
+        return
+
+    if args.mongo_db == 'uniqlo':
+        raise ValueError('Refusing to benchmark against the production database')
+    client = MongoClient(args.mongo_url, serverSelectionTimeoutMS=5000)
+    client.drop_database(args.mongo_db)
+    client.close()
+
+    server, base_url = start_server(
+        fixtures, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        max_page_size=args.max_page_size, translation_latency=args.translation_latency,
+        translation_error_rate=args.translation_error_rate, seed=args.seed,
+    )
+    # the pipelines and spiders read these from the environment; load_dotenv doesn't override them
+    os.environ.update({
+        'MONGO_URL': args.mongo_url,
+        'MONGO_DB': args.mongo_db,
+        'OPENAI_API_KEY': 'benchmark',
+        'OPENAI_BASE_URL': f'{base_url}/v1',
+        'MAX_REVIEWS_TO_SCRAPE': str(10 ** 9),
+    })
+    os.environ.pop('FORCE_DROP_COLLECTION', None)
+    os.environ.pop('FORCE_CRAWLING', None)
+    try:
+        results = run_spiders(build_settings(base_url, args), args.spiders, '127.0.0.1')
+    finally:
+        server.terminate()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({
+                'time': int(time.time()),
+                'revision': git_revision(),
+                'arguments': {key: value for key, value in vars(args).items() if key != 'output'},
+                'results': results,
+            }) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import json
+import multiprocessing
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+API_PREFIX = '/jp/api/commerce/v5/ja'
+REVIEWS_PATH = re.compile(re.escape(API_PREFIX) + r'/products/([^/]+)/reviews$')
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Uniqlo product and review API and the OpenAI chat completions endpoint,
+    with configurable latency and error rates
+    """
+    daemon_threads = True
+
+    def __init__(self, address, fixtures, latency=0.0, jitter=0.0, error_rate=0.0, max_page_size=100,
+                 translation_latency=0.0, translation_error_rate=0.0, seed=0):
+        super().__init__(address, StandInHandler)
+        self.products = fixtures['products']
+        self.reviews = fixtures['reviews']
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # the review endpoint caps the page size like the real one does
+        self.max_page_size = max_page_size
+        self.translation_latency = translation_latency
+        self.translation_error_rate = translation_error_rate
+        self.random = random.Random(seed)
+
+    def delay(self, latency):
+        time.sleep(max(0.0, latency + self.random.uniform(-self.jitter, self.jitter)))
+
+    def should_fail(self, error_rate):
+        return error_rate > 0 and self.random.random() < error_rate
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == '/robots.txt':
+            body = b'User-agent: *\nAllow: /\n'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.server.delay(self.server.latency)
+        if self.server.should_fail(self.server.error_rate):
+            self.send_json({'status': 'nok'}, status=503)
+            return
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 20))
+        if url.path == f'{API_PREFIX}/products':
+            items = self.server.products
+            self.send_json({'status': 'ok', 'result': {
+                'items': items[offset:offset + limit],
+                'pagination': {'total': len(items), 'offset': offset, 'count': len(items[offset:offset + limit])},
+            }})
+            return
+        match = REVIEWS_PATH.match(url.path)
+        if match and match.group(1) in self.server.reviews:
+            reviews = self.server.reviews[match.group(1)]
+            limit = min(limit, self.server.max_page_size)
+            page = reviews[offset:offset + limit]
+            self.send_json({'status': 'ok', 'result': {
+                'reviews': page,
+                'pagination': {'total': len(reviews), 'offset': offset, 'count': len(page), 'limit': limit},
+            }})
+            return
+        self.send_json({'status': 'nok'}, status=404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urlsplit(self.path).path != '/v1/chat/completions':
+            self.send_json({'error': {'message': 'not found'}}, status=404)
+            return
+        self.server.delay(self.server.translation_latency)
+        if self.server.should_fail(self.server.translation_error_rate):
+            self.send_json({'error': {'message': 'rate limited', 'type': 'requests'}}, status=429)
+            return
+        request = json.loads(body)
+        payload = json.loads(request['messages'][-1]['content'])
+        translations = [
+            {'review_id': review['review_id'], 'title': f"[en] {review['title']}", 'comment': f"[en] {review['comment']}"}
+            for review in payload.get('reviews', [])
+        ]
+        self.send_json({
+            'id': 'chatcmpl-benchmark',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'benchmark'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': json.dumps({'translations': translations}, ensure_ascii=False)},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': len(body), 'completion_tokens': len(body), 'total_tokens': 2 * len(body)},
+        })
+
+
+def serve(fixtures, ready, host='127.0.0.1', port=0, **options):
+    server = StandInServer((host, port), fixtures, **options)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(fixtures, host='127.0.0.1', port=0, **options):
+    """
+    Run the stand-in server in a child process, so it neither shares the crawler's GIL nor its RSS
+    :param fixtures: fixtures dict, see benchmark/fixtures.py
+    :param options: StandInServer options (latency, error_rate, translation_latency, ...)
+    :return: tuple of (process, base url of the server)
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(fixtures, ready, host, port), kwargs=options, daemon=True)
+    process.start()
+    port = ready.get(timeout=30)
+    return process, f'http://{host}:{port}'
@@ -1,36 +1,24 @@
 import time
 from openai import OpenAI, OpenAIError
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
 import logging
+from .utils.rate_limiter import RateLimiter
 
 
 class OpenAiApiClient:
 
-    def __init__(self, api_key, assistant_id):
+    def __init__(self, api_key, assistant_id, rate_limiter=None):
         self.api_key = api_key
         self.assistant_id = assistant_id
         self.client = OpenAI(
             api_key=self.api_key,
         )
-        self.last_request_time = time.time()
-
-        self.lock = Lock()
-        self.request_count = 0
+        self.rate_limiter = rate_limiter or RateLimiter()
 
     def translate_japanese(self, text, max_retry=3):
         retry_count = 0
         while retry_count < max_retry:
-            with self.lock:
-                current_time = int(time.time())
-                if current_time - self.last_request_time >= 60:
-                    self.request_count = 0
-                    self.last_request_time = current_time
-
-                if self.request_count >= 60:
-                    time.sleep(60 - (current_time - self.last_request_time))
-
-                self.request_count += 1
+            self.rate_limiter.acquire(2 * len(text))
             try:
                 logging.info(f"Translating: {text}")
                 thread = self.client.beta.threads.create()
@@ -47,11 +35,12 @@ class OpenAiApiClient:
                         if message.role == "assistant":
                             return message.content[0].text.value
             except OpenAIError as e:
-                if e.__getattribute__('status_code') == 429:
+                if getattr(e, 'status_code', None) == 429:
                     retry_count += 1
+                    response = getattr(e, 'response', None)
+                    retry_after = RateLimiter.retry_after(response.headers) if response is not None else None
                     logging.info('Too many requests, waiting for reset')
-                    time.sleep(10)  # wait for 10 seconds
-                    print('Too many requests, waiting for reset')
+                    self.rate_limiter.block_for(retry_after or 10)
                 else:
                     retry_count += 1
                     if retry_count >= max_retry:
@@ -0,0 +1,140 @@
+# Per-stage latency histograms and queue depths of a crawl, and opt-in profiles of its stages
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import json
+import logging
+import os
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+from twisted.web import resource, server
+
+from .utils.metrics import StageMetrics
+from .utils.profiling import StageProfiler
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self.metrics.prometheus_text().encode('utf-8')
+
+
+class StageMetricsExtension:
+    """
+    Report the StageMetrics of the crawler: download latency is taken from the responses, the
+    callbacks are timed by CallbackTimingMiddleware and the translation and Mongo stages by the
+    pipelines. Queue depths are sampled every STAGE_METRICS_INTERVAL seconds. The summaries go
+    into the stats collector, the whole snapshot into STAGE_METRICS_FILE at close, and with
+    STAGE_METRICS_PORT set the histograms are served in the Prometheus text format on localhost.
+    """
+
+    def __init__(self, crawler, metrics, interval=1.0, output_file=None, port=None, host='127.0.0.1'):
+        self.crawler = crawler
+        self.metrics = metrics
+        self.interval = interval
+        self.output_file = output_file
+        self.port = port
+        self.host = host
+        self.sample_loop = None
+        self.listening_port = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('STAGE_METRICS_ENABLED'):
+            raise NotConfigured
+        extension = cls(
+            crawler,
+            StageMetrics.from_crawler(crawler),
+            interval=crawler.settings.getfloat('STAGE_METRICS_INTERVAL', 1.0),
+            output_file=crawler.settings.get('STAGE_METRICS_FILE'),
+            port=crawler.settings.getint('STAGE_METRICS_PORT') or None,
+            host=crawler.settings.get('STAGE_METRICS_HOST', '127.0.0.1'),
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+        return extension
+
+    def spider_opened(self, spider):
+        engine = self.crawler.engine
+        self.metrics.register_gauge('scheduler', lambda: len(engine.slot.scheduler))
+        self.metrics.register_gauge('downloader/active', lambda: len(engine.downloader.active))
+        self.metrics.register_gauge('scraper/responses', lambda: len(engine.scraper.slot.queue) +
+                                    len(engine.scraper.slot.active))
+        # items handed to the pipelines and not finished yet, including those waiting for a translation
+        self.metrics.register_gauge('scraper/items_in_flight', lambda: engine.scraper.slot.itemproc_size)
+        self.sample_loop = task.LoopingCall(self.sample)
+        self.sample_loop.start(self.interval, now=True)
+        if self.port:
+            from twisted.internet import reactor
+            # one port per shard when the launcher runs several processes on the machine
+            port = self.port + getattr(spider, 'shard', 0)
+            self.listening_port = reactor.listenTCP(port, server.Site(MetricsResource(self.metrics)),
+                                                    interface=self.host)
+            logging.info(f"Serving stage metrics on http://{self.host}:{port}/metrics")
+
+    def sample(self):
+        self.metrics.sample_gauges()
+        self.metrics.update_stats(self.crawler.stats)
+
+    def response_received(self, response, request, spider):
+        # set by the download handler, from sending the request to receiving the whole response
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.metrics.observe('download', latency)
+
+    def spider_closed(self, spider, reason):
+        if self.sample_loop and self.sample_loop.running:
+            self.sample_loop.stop()
+        self.sample()
+        if self.listening_port is not None:
+            self.listening_port.stopListening()
+        if self.output_file:
+            self.dump(self.output_file % {'name': spider.name, 'shard': getattr(spider, 'shard', 0)}, reason)
+
+    def dump(self, path, reason):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'finish_reason': reason, **self.metrics.snapshot()}, f, indent=2)
+        logging.info(f"Wrote stage metrics to {path}")
+
+
+class ProfilingExtension:
+    """
+    Write the profiles collected by CallbackProfilingMiddleware and the pipelines at close: per stage
+    a .pstats file (python -m pstats, snakeviz) and a .collapsed file (flamegraph.pl, speedscope)
+    in PROFILE_DIR. Only every PROFILE_SAMPLE_EVERY-th call of a stage is profiled.
+    """
+
+    def __init__(self, profiler, stats, directory='profiles'):
+        self.profiler = profiler
+        self.stats = stats
+        self.directory = directory
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PROFILE_ENABLED'):
+            raise NotConfigured
+        extension = cls(StageProfiler.from_crawler(crawler), crawler.stats,
+                        directory=crawler.settings.get('PROFILE_DIR', 'profiles'))
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_closed(self, spider, reason):
+        for stage, count in self.profiler.sampled.items():
+            self.stats.set_value(f'profile/{stage}/sampled', count)
+            self.stats.set_value(f'profile/{stage}/calls', self.profiler.calls[stage])
+        paths = self.profiler.dump(self.directory, f"{spider.name}-{getattr(spider, 'shard', 0)}")
+        if paths:
+            logging.info(f"Wrote {len(paths)} profile files to {self.directory}")
@@ -0,0 +1,157 @@
+# HTTP cache policy and storage for the Uniqlo API, used by Scrapy's HttpCacheMiddleware
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#module-scrapy.downloadermiddlewares.httpcache
+
+import os
+import pickle
+import re
+import sqlite3
+import time
+import zlib
+from email.utils import parsedate_to_datetime
+
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.extensions.httpcache import RFC2616Policy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+
+
+class UniqloApiCachePolicy(RFC2616Policy):
+    """
+    Serve cached API responses for a TTL that depends on the url, then revalidate them with
+    If-None-Match / If-Modified-Since where the response carried an ETag or Last-Modified.
+    A TTL of 0 revalidates on every request; urls without a TTL are not cached.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in settings.getlist('UNIQLO_HTTPCACHE_TTLS')]
+        default_ttl = settings.get('UNIQLO_HTTPCACHE_DEFAULT_TTL')
+        self.default_ttl = None if default_ttl is None else int(default_ttl)
+
+    def ttl_for(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+    def should_cache_request(self, request):
+        return request.method == 'GET' and self.ttl_for(request.url) is not None
+
+    def should_cache_response(self, response, request):
+        if response.status != 200:
+            return False
+        # a response revalidated on every request is only worth storing if it can be revalidated
+        return self.ttl_for(request.url) > 0 or b'ETag' in response.headers or b'Last-Modified' in response.headers
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        date = cachedresponse.headers.get(b'Date')
+        try:
+            stored_at = parsedate_to_datetime(date.decode()).timestamp()
+        except (AttributeError, TypeError, ValueError):
+            # no usable Date header: the time the storage wrote it
+            stored_at = request.meta.get('httpcache_stored_at')
+        age = time.time() - stored_at if stored_at is not None else float('inf')
+        if age < self.ttl_for(request.url):
+            return True
+
+        # stale: ask the server whether it changed instead of downloading it again
+        if b'ETag' in cachedresponse.headers:
+            request.headers[b'If-None-Match'] = cachedresponse.headers[b'ETag']
+        if b'Last-Modified' in cachedresponse.headers:
+            request.headers[b'If-Modified-Since'] = cachedresponse.headers[b'Last-Modified']
+        return False
+
+
+class UniqloHttpCacheMiddleware(HttpCacheMiddleware):
+    """
+    HttpCacheMiddleware that stores the cached response again after a 304, with the validators and
+    Date the server sent along, so its TTL starts over instead of every later request revalidating
+    """
+
+    REFRESHED_HEADERS = (b'Date', b'ETag', b'Last-Modified', b'Cache-Control', b'Expires')
+
+    def process_response(self, request, response, spider):
+        cachedresponse = request.meta.get('cached_response')
+        result = super().process_response(request, response, spider)
+        if cachedresponse is not None and result is cachedresponse and response.status == 304:
+            headers = Headers(cachedresponse.headers)
+            for name in self.REFRESHED_HEADERS:
+                if name in response.headers:
+                    headers[name] = response.headers[name]
+            self.storage.store_response(spider, request, cachedresponse.replace(headers=headers))
+            self.stats.inc_value('httpcache/refresh', spider=spider)
+        return result
+
+
+class SqliteCacheStorage:
+    """
+    Keep cached responses in one local SQLite file, with uncompressed bodies zlib-compressed.
+    Writes are committed every COMMIT_EVERY responses or COMMIT_INTERVAL seconds and at close,
+    a crash only loses the last few cache entries
+    """
+
+    COMMIT_EVERY = 100
+    COMMIT_INTERVAL = 5.0
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.connection = None
+        self.uncommitted = 0
+        self.last_commit_time = time.time()
+
+    def open_spider(self, spider):
+        self._fingerprinter = spider.crawler.request_fingerprinter
+        # one file per shard, SQLite doesn't like several processes writing to one file
+        name = spider.name if getattr(spider, 'shards', 1) <= 1 else f'{spider.name}-{spider.shard}'
+        path = os.path.join(self.cachedir, f'{name}.sqlite')
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'fingerprint TEXT PRIMARY KEY, url TEXT, status INTEGER, headers BLOB, body BLOB, '
+            'compressed INTEGER, stored_at REAL)'
+        )
+        spider.logger.debug(f'Using SQLite cache storage in {path}')
+
+    def close_spider(self, spider):
+        if self.connection is not None:
+            self.commit()
+            self.connection.close()
+
+    def retrieve_response(self, spider, request):
+        row = self.connection.execute(
+            'SELECT url, status, headers, body, compressed, stored_at FROM responses WHERE fingerprint = ?',
+            (self._fingerprinter.fingerprint(request).hex(),)
+        ).fetchone()
+        if row is None:
+            return None
+        url, status, headers, body, compressed, stored_at = row
+        if 0 < self.expiration_secs < time.time() - stored_at:
+            return None
+        request.meta['httpcache_stored_at'] = stored_at
+        headers = Headers(pickle.loads(headers))
+        body = zlib.decompress(body) if compressed else body
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        # bodies the server already compressed are stored as they are
+        compressed = b'Content-Encoding' not in response.headers
+        body = zlib.compress(response.body) if compressed else response.body
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (self._fingerprinter.fingerprint(request).hex(), response.url, response.status,
+             pickle.dumps(dict(response.headers), protocol=4), body, int(compressed), time.time())
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_EVERY or time.time() - self.last_commit_time >= self.COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+        self.last_commit_time = time.time()
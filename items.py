@@ -2,8 +2,14 @@
 #
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
+#
+# The items are slotted attrs classes, which itemadapter supports like scrapy.Item. Read and set
+# their fields as attributes (item.review_id); code that has to handle any item type goes
+# through ItemAdapter(item), and item_to_document turns an item into its Mongo document.
 
 import scrapy
+from attrs import define
+from itemadapter import ItemAdapter
 
 
 class UniqloreviewItem(scrapy.Item):
@@ -12,37 +18,41 @@ class UniqloreviewItem(scrapy.Item):
     pass
 
 
-class ProductItem(scrapy.Item):
-    product_id = scrapy.Field()
-    item_name = scrapy.Field()
-    prices = scrapy.Field()
-    color_names = scrapy.Field()
-    rating = scrapy.Field()
-    review_count = scrapy.Field()
-    product_image = scrapy.Field()
-    url = scrapy.Field()
-
-
-class ReviewItem(scrapy.Item):
-    product_id = scrapy.Field()
-    review_id = scrapy.Field()
-    height_range = scrapy.Field()
-    weight_range = scrapy.Field()
-    purchased_size = scrapy.Field()
-    age_range = scrapy.Field()
-    review_name = scrapy.Field()
-    comment = scrapy.Field()
-    fit = scrapy.Field()
-    gender = scrapy.Field()
-    location = scrapy.Field()
-    rate = scrapy.Field()
-    title = scrapy.Field()
-    created_date = scrapy.Field()
-    translated_title = scrapy.Field()
-    translated_comment = scrapy.Field()
-    scraped_time = scrapy.Field()
-    translated_review_title = scrapy.Field()
-    translated_review_comment = scrapy.Field()
-    translated = scrapy.Field()
-
-
+@define
+class ProductItem:
+    product_id: str = None
+    item_name: str = None
+    prices: float = None
+    color_names: list = None
+    rating: float = None
+    review_count: int = None
+    product_image: str = None
+    url: str = None
+
+
+@define
+class ReviewItem:
+    product_id: str = None
+    review_id: int = None
+    purchased_size: str = None
+    review_name: str = None
+    comment: str = None
+    fit: int = None
+    gender: str = None
+    location: str = None
+    rate: int = None
+    title: str = None
+    created_date: str = None
+    scraped_time: int = None
+    translated_review_title: str = None
+    translated_review_comment: str = None
+    translated: bool = None
+
+
+def item_to_document(item):
+    """
+    Build the Mongo document for an item, leaving out the fields that were never set
+    :param item: ProductItem, ReviewItem or any other item supported by itemadapter
+    :return: dict
+    """
+    return {name: value for name, value in ItemAdapter(item).items() if value is not None}
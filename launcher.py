@@ -0,0 +1,156 @@
+# Start one crawler process per shard and merge their stats into one report:
+#
+#     python -m uniqloReview.launcher reviewSpider --processes 8
+#
+# Each process runs the spider with -a shard=i -a shards=n, its own reactor and its own Mongo
+# connection pool, so parsing and translation bookkeeping use every core instead of one.
+
+import argparse
+import multiprocessing
+import os
+import pprint
+import queue
+import sys
+from datetime import datetime
+
+
+def project_settings(overrides=None):
+    """
+    Load the project settings without needing scrapy.cfg
+    :param overrides: dict of settings taking precedence over settings.py
+    :return: scrapy Settings
+    """
+    from scrapy.settings import Settings
+    from . import settings as settings_module
+
+    settings = Settings()
+    settings.setmodule(settings_module, priority='project')
+    if overrides:
+        settings.setdict(overrides, priority='cmdline')
+    return settings
+
+
+def spider_classes():
+    from .spiders.productSpider import ProductSpider
+    from .spiders.reviewScraper import ReviewScraperSpider
+    return {spider.name: spider for spider in (ProductSpider, ReviewScraperSpider)}
+
+
+def drop_reviews():
+    """
+    Drop the reviews collection once for FORCE_DROP_COLLECTION, before any shard has stored reviews
+    """
+    from dotenv import load_dotenv
+    from .utils.utils import MongoDBHandler
+
+    load_dotenv()
+    if os.getenv('FORCE_DROP_COLLECTION') != 'True':
+        return
+    mongo_url = os.getenv('MONGO_URL')
+    if not mongo_url:
+        raise SystemExit('MONGO_URL is not set')
+    mongodb_handler = MongoDBHandler(mongo_url, os.getenv('MONGO_DB', 'uniqlo'))
+    try:
+        mongodb_handler.drop_collection('reviews')
+        mongodb_handler.clear_review_high_water_marks('products')
+    finally:
+        mongodb_handler.close_client()
+    print('Dropped the reviews collection')
+
+
+def run_shard(spider_name, shard, shards, spider_args, overrides, results):
+    from scrapy.crawler import CrawlerProcess
+
+    settings = project_settings({
+        'LOG_FORMAT': f'%(asctime)s [shard {shard}/{shards}] [%(name)s] %(levelname)s: %(message)s',
+        **overrides,
+    })
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(spider_classes()[spider_name])
+    process.crawl(crawler, shard=shard, shards=shards, **spider_args)
+    process.start()
+    results.put((shard, crawler.stats.get_stats()))
+
+
+def merge_stats(shard_stats):
+    """
+    Merge the stats of the shards: counters (and memory, the processes run side by side) are summed,
+    start times take the earliest, finish times, elapsed time and depth the latest or largest,
+    anything else is listed once per distinct value
+    :param shard_stats: list of stats dicts
+    :return: merged stats dict
+    """
+    merged = {}
+    for key in sorted({key for stats in shard_stats for key in stats}):
+        values = [stats[key] for stats in shard_stats if key in stats]
+        if all(isinstance(value, datetime) for value in values):
+            merged[key] = min(values) if 'start' in key else max(values)
+        elif all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+            merged[key] = max(values) if key in ('elapsed_time_seconds', 'request_depth_max') else sum(values)
+        else:
+            merged[key] = ', '.join(sorted({str(value) for value in values}))
+    return merged
+
+
+def parse_pairs(pairs, option):
+    parsed = {}
+    for pair in pairs:
+        name, separator, value = pair.partition('=')
+        if not separator:
+            raise SystemExit(f'{option} expects NAME=VALUE, got {pair!r}')
+        parsed[name] = value
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a spider as several sharded crawler processes')
+    parser.add_argument('spider', choices=['productSpider', 'reviewSpider'])
+    parser.add_argument('-n', '--processes', type=int, default=os.cpu_count() or 1,
+                        help='number of shards, one process each (default: one per core)')
+    parser.add_argument('-a', dest='spider_args', action='append', default=[], metavar='NAME=VALUE',
+                        help='spider argument passed to every shard')
+    parser.add_argument('-s', dest='settings', action='append', default=[], metavar='NAME=VALUE',
+                        help='setting passed to every shard')
+    args = parser.parse_args()
+
+    spider_args = parse_pairs(args.spider_args, '-a')
+    overrides = parse_pairs(args.settings, '-s')
+    if args.spider == 'reviewSpider':
+        drop_reviews()
+    # the shards inherit the environment, load_dotenv in them doesn't override it
+    os.environ['FORCE_DROP_COLLECTION'] = 'False'
+    # spawn, so no process inherits a reactor or a Mongo client from the launcher
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [
+        context.Process(target=run_shard, args=(args.spider, shard, args.processes, spider_args, overrides, results))
+        for shard in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    shard_stats = {}
+    while len(shard_stats) < len(processes) and (any(process.is_alive() for process in processes) or not results.empty()):
+        try:
+            shard, stats = results.get(timeout=1)
+        except queue.Empty:
+            continue
+        shard_stats[shard] = stats
+    for process in processes:
+        process.join()
+
+    for shard in range(args.processes):
+        stats = shard_stats.get(shard)
+        if stats is None:
+            print(f'shard {shard}: exited with code {processes[shard].exitcode} without reporting stats')
+        else:
+            print(f"shard {shard}: {stats.get('item_scraped_count', 0)} items, "
+                  f"{stats.get('downloader/request_count', 0)} requests, {stats.get('finish_reason')}")
+    print('Merged Scrapy stats:')
+    pprint.pprint(merge_stats(list(shard_stats.values())))
+    if len(shard_stats) < len(processes):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
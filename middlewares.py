@@ -5,12 +5,21 @@
 
 from scrapy import signals
 import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
 from scrapy.exceptions import IgnoreRequest, NotConfigured
-from scrapy.http import Response
+from scrapy.http import Request
+from twisted.internet import task
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from .utils.metrics import StageMetrics
+from .utils.profiling import StageProfiler
+from .utils.rate_limiter import RateLimiter
+
 
 class UniqloReviewSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -57,76 +66,206 @@ class UniqloReviewSpiderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
-        self.logger = logging.getLogger(__name__)
 
-    def process_response(self, request, response, spider):
-        if response.status in [404, 400, 500]:
-            self.logger.error(f"Failed to fetch {request.url}. Status code: {response.status}")
-            raise IgnoreRequest(f'Failed to fetch {request.url}. Status code: {response.status}')
-        elif isinstance(response, Response):
-            pass
 
-        return response
+class CallbackTimingMiddleware:
+    """
+    Time the spider callbacks (ProductSpider.parse, parse_review, ...) as callback/<name> stages.
+    Registered closest to the spider, so only the time spent inside the callback's generator is
+    counted, not the middlewares and the engine consuming its output.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('STAGE_METRICS_ENABLED'):
+            raise NotConfigured
+        return cls(StageMetrics.from_crawler(crawler))
+
+    def process_spider_output(self, response, result, spider):
+        callback = response.request.callback if response.request is not None else None
+        stage = f"callback/{getattr(callback, '__name__', 'parse')}"
+        elapsed = 0.0
+        outputs = iter(result)
+        while True:
+            start = time.perf_counter()
+            try:
+                output = next(outputs)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield output
+        self.metrics.observe(stage, elapsed)
+
+
+class CallbackProfilingMiddleware:
+    """
+    Profile every PROFILE_SAMPLE_EVERY-th response of each spider callback as callback/<name>,
+    covering only the time spent inside the callback's generator
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PROFILE_ENABLED'):
+            raise NotConfigured
+        return cls(StageProfiler.from_crawler(crawler))
+
+    def process_spider_output(self, response, result, spider):
+        callback = response.request.callback if response.request is not None else None
+        profile = self.profiler.sample(f"callback/{getattr(callback, '__name__', 'parse')}")
+        if profile is None:
+            yield from result
+            return
+        outputs = iter(result)
+        while True:
+            with self.profiler.running(profile):
+                try:
+                    output = next(outputs)
+                except StopIteration:
+                    break
+            yield output
 
-    def process_exception(self, request, exception, spider):
-        if isinstance(exception, IgnoreRequest):
-            self.logger.error(f"Failed to fetch {request.url}. Status code: {response.status}")
-            return None
-        else:
-            return exception
 
 class CheckDuplicatesMiddleware:
     def __init__(self):
         self.seen = set()
 
     def process_request(self, request, spider):
-        if getattr(spider, 'duplicates_found', False):
-            raise IgnoreRequest("Duplicate found")
+        # only drop pages past a product's already-known reviews, other products keep crawling
+        product_id = request.meta.get('product_id')
+        if product_id is not None and hasattr(spider, 'skip_page') and \
+                spider.skip_page(product_id, request.meta.get('offset')):
+            raise IgnoreRequest(f"Already-known reviews reached for product {product_id}")
 
 
+class AdaptiveRetryMiddleware(RetryMiddleware):
+    """
+    Scrapy's RetryMiddleware (RETRY_TIMES, RETRY_HTTP_CODES, RETRY_EXCEPTIONS) with a delay before each
+    retry: the Retry-After of the response if it has one, else exponential backoff with full jitter
+    from RETRY_BACKOFF_BASE up to RETRY_BACKOFF_MAX seconds.
 
-class UniqloReviewDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    With ADAPTIVE_CONCURRENCY_ENABLED it also sets the concurrency of each downloader slot by AIMD:
+    a 429/503 or a window of ADAPTIVE_CONCURRENCY_WINDOW responses slower than
+    ADAPTIVE_CONCURRENCY_TARGET_LATENCY on average halves it, a window without either adds one,
+    between ADAPTIVE_CONCURRENCY_MIN and ADAPTIVE_CONCURRENCY_MAX.
+    """
+
+    throttle_codes = (429, 503)
+
+    def __init__(self, settings, crawler=None):
+        super().__init__(settings)
+        self.crawler = crawler
+        self.stats = crawler.stats if crawler is not None else None
+        self.backoff_base = settings.getfloat('RETRY_BACKOFF_BASE', 1.0)
+        self.backoff_max = settings.getfloat('RETRY_BACKOFF_MAX', 60.0)
+        self.adaptive = settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED', False) and crawler is not None
+        self.min_concurrency = max(1, settings.getint('ADAPTIVE_CONCURRENCY_MIN', 1))
+        self.max_concurrency = max(self.min_concurrency, settings.getint('ADAPTIVE_CONCURRENCY_MAX', 16))
+        self.window_size = settings.getint('ADAPTIVE_CONCURRENCY_WINDOW', 20)
+        self.target_latency = settings.getfloat('ADAPTIVE_CONCURRENCY_TARGET_LATENCY', 2.0)
+        # slot key -> responses, throttled responses and summed latency of the current window
+        self.windows = {}
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
-        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
-        return s
-
-    def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
-        return None
+        return cls(crawler.settings, crawler)
 
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
-
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
-        return response
+        if self.adaptive and 'cached' not in response.flags:
+            self.observe(request, response)
+        result = super().process_response(request, response, spider)
+        if isinstance(result, Request):
+            return self.delay(result, self.backoff_delay(result, response))
+        return result
 
     def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
+        result = super().process_exception(request, exception, spider)
+        if isinstance(result, Request):
+            return self.delay(result, self.backoff_delay(result))
+        return result
 
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+    def backoff_delay(self, request, response=None):
+        """
+        Seconds to wait before sending the retry
+        :param request: the retry request, its retry_times meta counts the attempts so far
+        :param response: the response that is retried, if any
+        :return: the Retry-After of the response, or a jittered exponential backoff
+        """
+        retry_after = self.retry_after(response.headers) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        attempt = request.meta.get('retry_times', 1)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
 
-    def spider_opened(self, spider):
-        spider.logger.info("Spider opened: %s" % spider.name)
+    @staticmethod
+    def retry_after(headers):
+        seconds = RateLimiter.retry_after(headers)
+        if seconds is not None:
+            return max(0.0, seconds)
+        value = headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, parsedate_to_datetime(value.decode('latin-1')).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, request, seconds):
+        if seconds <= 0:
+            return request
+        if self.stats is not None:
+            self.stats.inc_value('retry/backoff_seconds', seconds)
+        from twisted.internet import reactor
+        # the retry keeps its place among the downloader's active requests while it waits,
+        # so a burst of errors also holds back new requests
+        return task.deferLater(reactor, seconds, lambda: request)
+
+    def observe(self, request, response):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+        window = self.windows.setdefault(key, {'responses': 0, 'throttled': 0, 'latency': 0.0, 'since_decrease': 0})
+        window['responses'] += 1
+        window['since_decrease'] += 1
+        window['latency'] += request.meta.get('download_latency', 0.0)
+        if response.status in self.throttle_codes:
+            window['throttled'] += 1
+            # the responses to requests sent before the last decrease don't count against the new rate
+            if window['since_decrease'] >= slot.concurrency:
+                self.decrease(key, slot, window, f'HTTP {response.status}')
+            return
+        if window['responses'] < self.window_size:
+            return
+        if window['latency'] / window['responses'] > self.target_latency:
+            self.decrease(key, slot, window, f"mean latency {window['latency'] / window['responses']:.2f}s")
+        elif not window['throttled']:
+            self.set_concurrency(key, slot, min(self.max_concurrency, slot.concurrency + 1), 'increase')
+            self.reset(window)
+        else:
+            self.reset(window)
+
+    def decrease(self, key, slot, window, reason):
+        concurrency = max(self.min_concurrency, slot.concurrency // 2)
+        if concurrency < slot.concurrency:
+            logging.info(f"Lowering the concurrency of {key} from {slot.concurrency} to {concurrency} ({reason})")
+        self.set_concurrency(key, slot, concurrency, 'decrease')
+        self.reset(window)
+        window['since_decrease'] = 0
+
+    def set_concurrency(self, key, slot, concurrency, change):
+        if concurrency != slot.concurrency and self.stats is not None:
+            self.stats.inc_value(f'adaptive_concurrency/{change}')
+        slot.concurrency = concurrency
+        if self.stats is not None:
+            self.stats.set_value(f'adaptive_concurrency/{key}', concurrency)
+
+    @staticmethod
+    def reset(window):
+        window.update(responses=0, throttled=0, latency=0.0)
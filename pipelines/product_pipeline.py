@@ -1,17 +1,48 @@
 import os
+import time
+import logging
 
+import attrs
 import pymongo
 import pymongo.errors
+from pymongo import UpdateOne
 from dotenv import load_dotenv
-from itemadapter import ItemAdapter
+from twisted.internet import task
+from ..items import ProductItem, item_to_document
 from ..utils.utils import Utils
+from ..utils.indexes import ensure_indexes
+from ..utils.metrics import StageMetrics
+from ..utils.profiling import StageProfiler, profiled
+from ..utils.price_history import PRICE_HISTORY_COLLECTION, price_observation
+
+# the fields of the listing besides the id and price, rewritten only when one of them changed
+LISTING_FIELDS = tuple(field.name for field in attrs.fields(ProductItem) if field.name not in ('product_id', 'prices'))
+
 
 class ProductPipeline:
     collection_name = 'products'
 
-    def __init__(self, mongo_url, mongo_db):
+    def __init__(self, mongo_url, mongo_db, bulk_write=False, bulk_size=500, flush_interval=5.0, metrics=None,
+                 profiler=None):
         self.mongo_url = mongo_url
         self.mongo_db = mongo_db
+        self.bulk_write = bulk_write
+        self.bulk_size = bulk_size
+        self.flush_interval = flush_interval
+        # product_id -> {'$set': changed fields, '$unset': removed fields}, so a product seen twice in
+        # one batch only produces one upsert
+        self.buffer = {}
+        self.pending_prices = []
+        # product_id -> (price, price_date, listing fingerprint), loaded in open_spider
+        self.snapshot = {}
+        # snapshot entries of the buffered updates, moved to the snapshot once they are written
+        self.pending_snapshot = {}
+        self.unchanged_count = 0
+        self.last_flush_time = time.time()
+        self.flush_loop = None
+        self.metrics = metrics or StageMetrics()
+        self.profiler = profiler or StageProfiler()
+        self.metrics.register_gauge('product_pipeline/buffer', lambda: len(self.buffer))
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -27,73 +58,188 @@ class ProductPipeline:
             raise EnvironmentError('MONGO_URL is not set')
 
         mongo_db = os.getenv('MONGO_DB', 'uniqlo')
-        return cls(mongo_url, mongo_db)
+        return cls(
+            mongo_url,
+            mongo_db,
+            bulk_write=crawler.settings.getbool('PRODUCT_BULK_WRITE', False),
+            bulk_size=crawler.settings.getint('PRODUCT_BULK_SIZE', 500),
+            flush_interval=crawler.settings.getfloat('PRODUCT_BULK_FLUSH_INTERVAL', 5.0),
+            metrics=StageMetrics.from_crawler(crawler),
+            profiler=StageProfiler.from_crawler(crawler),
+        )
 
     def open_spider(self, spider):
         self.client = pymongo.MongoClient(self.mongo_url)
         self.db = self.client[self.mongo_db]
         self.collection = self.db[self.collection_name]
+        self.price_history = self.db[PRICE_HISTORY_COLLECTION]
+        ensure_indexes(self.db)
+        self.snapshot = self.load_snapshot()
+        if self.bulk_write and self.flush_interval > 0:
+            # flush on a timer as well, so a half-full buffer doesn't wait for the end of the crawl
+            self.flush_loop = task.LoopingCall(self.flush, spider)
+            self.flush_loop.start(self.flush_interval, now=False)
 
     def close_spider(self, spider):
+        if self.flush_loop and self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush(spider)
+        logging.info(f"{self.unchanged_count} products were unchanged and not written")
         self.client.close()
 
+    @profiled('pipeline/product')
     def process_item(self, item, spider):
         if item.__class__.__name__ == 'ProductItem':
             try:
-                item_dict = ItemAdapter(item).asdict()
-                self.update_prices(item_dict)
+                item_dict = item_to_document(item)
+                update, observation = self.build_update(item_dict)
+                if update is None:
+                    self.unchanged_count += 1
+                elif self.bulk_write:
+                    self.buffer_item(item_dict.get('product_id'), update, observation, spider)
+                else:
+                    self.update_prices(item_dict.get('product_id'), update, observation)
             except pymongo.errors.DuplicateKeyError:
-                spider.duplicates_found = True
+                # another process upserted the product first, its next listing updates it
+                logging.warning(f"Product {item.product_id} was inserted concurrently")
         return item
 
-    def update_prices(self, item_dict):
+    def load_snapshot(self):
+        """
+        Load the last price, its date and a fingerprint of the listing fields of every stored product
+        with one projected query, so change detection needs no reads per item
+        :return: dict of product_id -> (price, price_date, listing fingerprint)
+        """
+        projection = {'_id': 0, 'product_id': 1, 'price': 1, 'price_date': 1, **{key: 1 for key in LISTING_FIELDS}}
+        snapshot = {
+            product['product_id']: (product.get('price'), product.get('price_date'), self.listing_fingerprint(product))
+            for product in self.collection.find({}, projection)
+        }
+        logging.info(f"Loaded the price snapshot of {len(snapshot)} products")
+        return snapshot
+
+    @staticmethod
+    def listing_fingerprint(document):
+        values = (document.get(key) for key in LISTING_FIELDS)
+        return hash(tuple(tuple(value) if isinstance(value, list) else value for value in values))
+
+    def buffer_item(self, product_id, update, observation, spider):
+        """
+        Add the product's update to the write buffer and flush it once the size or time threshold is reached
+        :param product_id: the product id
+        :param update: the update document from build_update
+        :param observation: price_history observation or None
+        :param spider: the running spider
+        """
+        fields = self.buffer.setdefault(product_id, {'$set': {}, '$unset': {}})
+        for key, value in update.get('$set', {}).items():
+            fields['$set'][key] = value
+            fields['$unset'].pop(key, None)
+        for key in update.get('$unset', {}):
+            fields['$unset'][key] = ''
+            fields['$set'].pop(key, None)
+        if observation:
+            self.pending_prices.append(observation)
+        if len(self.buffer) >= self.bulk_size or time.time() - self.last_flush_time >= self.flush_interval:
+            self.flush(spider)
+
+    def flush(self, spider=None):
+        """
+        Write all buffered products as one unordered bulk_write of upserts, and their price changes
+        as one insert_many into price_history. Products whose write failed keep their old snapshot
+        entry and get no price observation.
+        :param spider: the running spider
         """
-        Update the prices for product
+        self.last_flush_time = time.time()
+        observations, self.pending_prices = self.pending_prices, []
+        pending_snapshot, self.pending_snapshot = self.pending_snapshot, {}
+        failed = set()
+        if self.buffer:
+            product_ids = list(self.buffer)
+            operations = [UpdateOne({'product_id': product_id},
+                                    {operator: values for operator, values in fields.items() if values}, upsert=True)
+                          for product_id, fields in self.buffer.items()]
+            self.buffer = {}
+            try:
+                with self.metrics.time('mongo/products_bulk_write'):
+                    result = self.collection.bulk_write(operations, ordered=False)
+                logging.info(f"Flushed {len(operations)} products: {result.upserted_count} inserted, "
+                             f"{result.modified_count} updated")
+            except pymongo.errors.BulkWriteError as e:
+                write_errors = e.details.get('writeErrors', [])
+                failed = {product_ids[error['index']] for error in write_errors}
+                logging.error(f"Bulk write of products failed for {len(write_errors)} of {len(operations)} operations")
+        self.snapshot.update({product_id: entry for product_id, entry in pending_snapshot.items()
+                              if product_id not in failed})
+        self.record_prices([observation for observation in observations if observation['product_id'] not in failed])
+
+    def build_update(self, item_dict):
+        """
+        Compare the product with the snapshot and build its update. The listing fields are only written
+        when they changed (the ones no longer listed are unset), the latest price (and a price_history
+        observation) only for a new product or a price change. The snapshot entry matching the update is
+        kept in pending_snapshot until the write succeeds.
         :param item_dict: item dictionary
+        :return: tuple of (update document or None if nothing changed, observation or None)
         """
         product_id = item_dict.get('product_id')
-        existing_product = self.collection.find_one({'product_id': product_id})
-        if existing_product:
-            self.add_new_price(existing_product, item_dict)
-        else:
-            self.insert_new_product(item_dict)
-
-    def add_new_price(self, existing_product, item_dict):
+        now = Utils.get_datetime()
+        new_price = item_dict.get('prices')
+        # a product listed twice before the flush compares against its buffered update
+        last_price, last_date, fingerprint = self.pending_snapshot.get(
+            product_id, self.snapshot.get(product_id, (None, None, None)))
+        new_fingerprint = self.listing_fingerprint(item_dict)
+        update = {}
+        # refresh the listing fields, the review crawl plan compares against review_count
+        if new_fingerprint != fingerprint:
+            listed = {key: value for key, value in item_dict.items() if key not in ('product_id', 'prices')}
+            if listed:
+                update['$set'] = listed
+            removed = {key: '' for key in LISTING_FIELDS if item_dict.get(key) is None}
+            if removed:
+                update['$unset'] = removed
+        observation = None
+        if self.is_price_change(last_price, last_date, new_price, now):
+            update.setdefault('$set', {}).update(price=new_price, price_date=now)
+            observation = price_observation(product_id, new_price, now)
+            last_price, last_date = new_price, now
+        if not update:
+            return None, None
+        self.pending_snapshot[product_id] = (last_price, last_date, new_fingerprint)
+        return update, observation
+
+    @staticmethod
+    def is_price_change(last_price, last_date, new_price, now):
         """
-        Add a new price to the existing product
-        :param existing_product:
-        :param item_dict:
+        Check if the price has to be recorded: the product has no price yet, or the last price is
+        different from the new price and last price date is > 86400s
         """
-        new_price_info = self.format_price_info(item_dict['prices'])
-        last_price_entry = existing_product['prices'][-1] if 'prices' in existing_product and existing_product['prices'] else None
-
-        # if last price is different from the new price and last price date is > 86400s
-        if last_price_entry and last_price_entry['price'] != new_price_info[0]['price'] and \
-                (Utils.get_datetime() - last_price_entry['date']) >= 86400:
-            self.db[self.collection_name].update_one(
-                {'product_id': existing_product['product_id']},
-                {'$push': {'prices': {'$each': new_price_info}}}
-            )
-
-    def insert_new_product(self, item_dict):
+        if last_date is None:
+            return True
+        return last_price != new_price and now - last_date >= 86400
+
+    def record_prices(self, observations):
         """
-        Insert a new product into the database
-        :param item_dict:
+        Append price observations to the price_history time-series collection
+        :param observations: list of documents built with price_observation
         """
-        item_dict['prices'] = self.format_price_info(item_dict.get('prices',[]))
-        self.collection.insert_one(item_dict)
-
-    def format_price_info(self, prices):
+        if not observations:
+            return
+        try:
+            with self.metrics.time('mongo/price_history_insert'):
+                self.price_history.insert_many(observations, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            logging.error(f"Failed to record {len(e.details.get('writeErrors', []))} of {len(observations)} prices")
+
+    def update_prices(self, product_id, update, observation):
         """
-        Format the price information
-        :param prices: the price information, either a single price or a list of prices
-        :return: formatted price information as a list of dictionaries with date and price
+        Write the product's update right away and record its price if it changed
+        :param product_id: the product id
+        :param update: the update document from build_update
+        :param observation: price_history observation or None
         """
-        current_date = Utils.get_datetime()
-        if not isinstance(prices, list):
-            formatted_prices = [{"date": current_date, "price": prices}]
-        else:
-            formatted_prices = [{"date": current_date, "price": price} for price in prices]
-        return formatted_prices
-
-
+        entry = self.pending_snapshot.pop(product_id)
+        with self.metrics.time('mongo/products_update'):
+            self.collection.update_one({'product_id': product_id}, update, upsert=True)
+        self.snapshot[product_id] = entry
+        self.record_prices([observation] if observation else [])
@@ -1,89 +1,285 @@
 import logging
+import time
 import pymongo, pymongo.errors
 from scrapy.exceptions import NotConfigured, DropItem
 from itemadapter import ItemAdapter
+from ..items import item_to_document
 from dotenv import load_dotenv
+from twisted.internet import defer, task, threads
 from ..utils.openAIClient import OpenAiApiClient
+from ..utils.translation_cache import TranslationCache
+from ..utils.rate_limiter import RateLimiter
+from ..utils.indexes import ensure_indexes, check_query_plans
+from ..utils.metrics import StageMetrics
+from ..utils.profiling import StageProfiler, profiled
+from ..utils.review_id_set import ReviewIdSet
 import os
 
 
 
 class ReviewPipeline:
-    def __init__(self):
+    def __init__(self, bulk_size=500, flush_interval=5.0, translation_concurrency=8,
+                 translation_batch_tokens=3000, translation_batch_size=20, translation_batch_interval=2.0,
+                 translation_cache_size=10000, rate_limiter=None, check_indexes=False, stats=None,
+                 metrics=None, profiler=None, preload_review_ids=True, translate=True):
         load_dotenv()
         mongo_url = os.getenv('MONGO_URL')
         if not mongo_url:
             raise NotConfigured('MONGO_URL environment variable is not set')
         self.mongo_url = mongo_url
+        self.bulk_size = bulk_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush_time = time.time()
+        self.flush_loop = None
+        # caps the number of translations in flight, each one runs in the reactor thread pool
+        self.translation_semaphore = defer.DeferredSemaphore(translation_concurrency)
+        self.translation_batch_tokens = translation_batch_tokens
+        self.translation_batch_size = translation_batch_size
+        self.translation_batch_interval = translation_batch_interval
+        # (item, deferred) pairs waiting to be sent as one batch translation request
+        self.pending_translations = []
+        self.pending_tokens = 0
+        self.translation_loop = None
+        self.translation_cache_size = translation_cache_size
+        self.rate_limiter = rate_limiter
+        self.check_indexes = check_indexes
+        self.stats = stats
+        self.preload_review_ids = preload_review_ids
+        # with translate off, reviews are stored untranslated for utils/translation_backfill.py
+        self.translate = translate
+        self.translation_cache = None
+        # review ids already stored or accepted in this crawl, see open_spider
+        self.known_review_ids = ReviewIdSet()
+        self.metrics = metrics or StageMetrics()
+        self.profiler = profiler or StageProfiler()
+        self.metrics.register_gauge('review_pipeline/pending_translations', lambda: len(self.pending_translations))
+        self.metrics.register_gauge('review_pipeline/buffer', lambda: len(self.buffer))
+        # batches handed to the thread pool, waiting for the semaphore or being translated
+        self.translations_in_flight = 0
+        self.metrics.register_gauge('review_pipeline/translation_batches_in_flight', lambda: self.translations_in_flight)
 
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            bulk_size=crawler.settings.getint('REVIEW_BULK_SIZE', 500),
+            flush_interval=crawler.settings.getfloat('REVIEW_BULK_FLUSH_INTERVAL', 5.0),
+            translation_concurrency=crawler.settings.getint('TRANSLATION_CONCURRENCY', 8),
+            translation_batch_tokens=crawler.settings.getint('TRANSLATION_BATCH_TOKENS', 3000),
+            translation_batch_size=crawler.settings.getint('TRANSLATION_BATCH_SIZE', 20),
+            translation_batch_interval=crawler.settings.getfloat('TRANSLATION_BATCH_INTERVAL', 2.0),
+            translation_cache_size=crawler.settings.getint('TRANSLATION_CACHE_SIZE', 10000),
+            rate_limiter=RateLimiter(
+                requests_per_minute=crawler.settings.getint('OPENAI_REQUESTS_PER_MINUTE', 60),
+                tokens_per_minute=crawler.settings.getint('OPENAI_TOKENS_PER_MINUTE', 60000),
+                state_path=crawler.settings.get('OPENAI_RATE_LIMIT_FILE'),
+            ),
+            check_indexes=crawler.settings.getbool('MONGO_INDEX_CHECK', False),
+            stats=crawler.stats,
+            metrics=StageMetrics.from_crawler(crawler),
+            profiler=StageProfiler.from_crawler(crawler),
+            preload_review_ids=crawler.settings.getbool('REVIEW_ID_PRELOAD', True),
+            translate=crawler.settings.getbool('TRANSLATE_DURING_CRAWL', True),
+        )
 
     def open_spider(self, spider):
         self.client = pymongo.MongoClient(self.mongo_url)
-        self.db = self.client.uniqlo  # Adjust database name as needed
+        self.db = self.client[os.getenv('MONGO_DB', 'uniqlo')]
         self.reviews_collection = self.db.reviews
-        # Ensure unique index on review_id
-        self.reviews_collection.create_index([('review_id', pymongo.DESCENDING)], unique=True)
+        # Ensure unique index on review_id and the other indexes the crawl queries rely on
+        ensure_indexes(self.db)
+        if self.check_indexes:
+            check_query_plans(self.db)
+        if self.preload_review_ids:
+            # known reviews are dropped before they cost a translation or a failed insert
+            self.known_review_ids = ReviewIdSet.from_collection(self.reviews_collection)
+        if self.translate:
+            self.open_translation()
+        if self.flush_interval > 0:
+            # flush on a timer as well, so a half-full buffer doesn't wait for the end of the crawl
+            self.flush_loop = task.LoopingCall(self.flush, spider)
+            self.flush_loop.start(self.flush_interval, now=False)
+
+    def open_translation(self):
+        """
+        Set up the translation client, its cache and the timer sending partial batches
+        """
+        # kept in its own collection so FORCE_DROP_COLLECTION doesn't throw the translations away
+        self.translation_cache = TranslationCache(self.db.translations, max_size=self.translation_cache_size)
         self.translate_client = OpenAiApiClient(
             api_key=os.getenv('OPENAI_API_KEY'),
-            assistant_id=os.getenv('TRANSLATION_ASSISTANT')
+            assistant_id=os.getenv('TRANSLATION_ASSISTANT'),
+            model=os.getenv('TRANSLATION_MODEL', 'gpt-3.5-turbo-1106'),
+            max_batch_tokens=self.translation_batch_tokens,
+            cache=self.translation_cache,
+            rate_limiter=self.rate_limiter,
+            metrics=self.metrics,
         )
+        # send partially filled translation batches when reviews stop coming in
+        self.translation_loop = task.LoopingCall(self.dispatch_translations)
+        self.translation_loop.start(self.translation_batch_interval, now=False)
 
     def close_spider(self, spider):
+        if self.translation_loop and self.translation_loop.running:
+            self.translation_loop.stop()
+        if self.flush_loop and self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush(spider)
+        self.update_cache_stats()
         self.client.close()
 
+    @profiled('pipeline/review')
     def process_item(self, item, spider):
         # Ensure this pipeline only processes ReviewItem objects
         if item.__class__.__name__ == 'ReviewItem':
-            item = self.translate_text(item)
-            self._process_review_item(item, spider)
+            if item.review_id in self.known_review_ids:
+                self.skip_known_review(item, spider)
+            self.known_review_ids.add(item.review_id)
+            if item.translated or not self.translate:
+                return self._process_review_item(item, spider)
+            d = defer.Deferred()
+            d.addCallback(self._process_review_item, spider)
+            self.pending_translations.append((item, d))
+            self.pending_tokens += self.translate_client.estimate_review_tokens(ItemAdapter(item))
+            if self.pending_tokens >= self.translation_batch_tokens or \
+                    len(self.pending_translations) >= self.translation_batch_size:
+                self.dispatch_translations()
+            return d
         elif item.__class__.__name__ == 'ProductItem':
             pass
         else:
             logging.warning(f"ReviewPipeline encountered an unexpected item type: {item.__class__.__name__}")
-            spider.duplicates_found = True
-            raise DropItem(f"Duplicate review found: {item.get('review_id')}")
+            raise DropItem(f"Duplicate review found: {ItemAdapter(item).get('review_id')}")
 
+    def skip_known_review(self, item, spider):
+        """
+        Drop a review that is already stored (or already on its way there in this crawl), and stop
+        scheduling more pages of its product like a duplicate insert would
+        :param item: the ReviewItem
+        :param spider: the running spider
+        """
+        if self.stats is not None:
+            self.stats.inc_value('review_pipeline/known_reviews_skipped')
+        if hasattr(spider, 'stop_pagination'):
+            spider.stop_pagination(item.product_id)
+        if hasattr(spider, 'review_stored'):
+            spider.review_stored(item.product_id, item.review_id)
+        raise DropItem(f"Review already stored: {item.review_id}")
+
+    # runs once the translation is back, so process_item alone would miss the buffering and flushes
+    @profiled('pipeline/review_store')
     def _process_review_item(self, review_item, spider):
-        # Convert the item to a dict and insert into the reviews collection
-        review_dict = ItemAdapter(review_item).asdict()
+        # Convert the item to its document and buffer it for the reviews collection
+        self.buffer.append(item_to_document(review_item))
+        if len(self.buffer) >= self.bulk_size or time.time() - self.last_flush_time >= self.flush_interval:
+            self.flush(spider)
+        return review_item
+
+    def flush(self, spider):
+        """
+        Insert all buffered reviews with one unordered insert_many, skipping duplicates
+        :param spider: the running spider
+        """
+        self.last_flush_time = time.time()
+        if not self.buffer:
+            return
+        reviews, self.buffer = self.buffer, []
+        failed = set()
         try:
-            self.reviews_collection.insert_one(review_dict)
-            logging.warning(f"Inserted review: {review_dict.get('review_id')}")
-        except pymongo.errors.DuplicateKeyError:
-            logging.warning(f"Duplicate review found and skipping: {review_dict.get('review_id')}")
-            spider.duplicates_found = True
+            with self.metrics.time('mongo/reviews_insert_many'):
+                self.reviews_collection.insert_many(reviews, ordered=False)
+            logging.info(f"Inserted {len(reviews)} reviews")
+        except pymongo.errors.BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            failed = {error['index'] for error in write_errors if error.get('code') != 11000}
+            duplicates = [error for error in write_errors if error.get('code') == 11000]
+            for error in duplicates:
+                review = reviews[error['index']]
+                logging.warning(f"Duplicate review found and skipping: {review.get('review_id')}")
+                # the product has reached reviews we already have, stop scheduling more of its pages
+                if hasattr(spider, 'stop_pagination'):
+                    spider.stop_pagination(review.get('product_id'))
+            for error in write_errors:
+                if error.get('code') != 11000:
+                    logging.error(f"Failed to insert review: {reviews[error['index']].get('review_id')}, {error.get('errmsg')}")
+            logging.info(f"Inserted {e.details.get('nInserted', 0)} reviews")
+        self.report_stored(spider, reviews, failed)
 
-    def drop_duplicates_review(self):
-        pass
+    @staticmethod
+    def report_stored(spider, reviews, failed):
+        """
+        Tell the spider which reviews are stored, so it only moves a product's high-water mark over
+        reviews that made it to the collection; duplicates count as stored
+        :param spider: the running spider
+        :param reviews: the review documents of the flush
+        :param failed: indexes of the reviews that could not be inserted
+        """
+        if not hasattr(spider, 'review_stored'):
+            return
+        for index, review in enumerate(reviews):
+            if index in failed:
+                spider.review_failed(review.get('product_id'), review.get('review_id'))
+            else:
+                spider.review_stored(review.get('product_id'), review.get('review_id'))
 
-    def combine_title_and_comments(self, item):
-        return f"{item['title']} [SEP] {item['comment']}"
+    def dispatch_translations(self):
+        """
+        Send the pending reviews as one batch translation request. The request runs off the reactor
+        thread so downloads and parsing keep going meanwhile; each item's deferred fires when it returns.
+        """
+        if not self.pending_translations:
+            return
+        batch, self.pending_translations = self.pending_translations, []
+        self.pending_tokens = 0
+        items = [item for item, _ in batch]
+        self.translations_in_flight += 1
+        d = self.translation_semaphore.run(threads.deferToThread, self.translate_batch, items)
+        d.addErrback(self._translation_failed, items)
+        d.addCallback(self._resolve_translations, batch)
+
+    def _translation_failed(self, failure, items):
+        logging.error(f"Failed to translate {len(items)} reviews: {failure.getErrorMessage()}")
+        return items
+
+    def _resolve_translations(self, items, batch):
+        self.translations_in_flight -= 1
+        self.update_cache_stats()
+        for item, d in batch:
+            d.callback(item)
+
+    def update_cache_stats(self):
+        if self.stats is None or self.translation_cache is None:
+            return
+        for key, value in self.translation_cache.stats().items():
+            self.stats.set_value(f'translation_cache/{key}', value)
 
     def translate_text(self, item):
-        combined_text = self.combine_title_and_comments(item)
-        if item.__class__.__name__ == 'ReviewItem' and not item.get('translated', False):
-            try:
-                translated_text = self.translate_client.translate_japanese(combined_text)
-                translated_parts = translated_text.split("[SEP]")
-                if len(translated_parts) == 2:
-                    item['translated_review_title'] = translated_parts[0].strip()
-                    item['translated_review_comment'] = translated_parts[1].strip()
-                    item['translated'] = True
-            except Exception as e:
-                logging.error(f"Failed to translate review: {item.get('review_id')}, {e}")
-        return item
-
-    def is_duplicate(self, item):
-        review_id = ItemAdapter(item).get('review_id')
-        exists = self.reviews_collection.find_one({'review_id': review_id})
-        if exists:
-            return True
-        return False
-
-    def store_in_database(self, item):
+        return self.translate_batch([item])[0]
+
+    def translate_batch(self, items):
+        """
+        Translate the title and comment of each review with structured batch requests
+        :param items: list of ReviewItem
+        :return: the same items, with translated fields set where the translation succeeded
+        """
+        reviews = [
+            {'review_id': str(item.review_id), 'title': item.title, 'comment': item.comment}
+            for item in items if not item.translated
+        ]
+        if not reviews:
+            return items
         try:
-            self.reviews_collection.insert_one(ItemAdapter(item).asdict())
-            logging.info(f"Inserted review: {item.get('review_id')}")
-        except pymongo.errors.DuplicateKeyError:
-            logging.warning(f"Duplicate review found and skipping: {item.get('review_id')}")
-            raise DropItem(f"Duplicate review found: {item.get('review_id')}")
+            with self.metrics.time('translation/batch'):
+                translations = self.translate_client.translate_reviews_batch(reviews)
+        except Exception as e:
+            logging.error(f"Failed to translate {len(reviews)} reviews: {e}")
+            return items
+        for item in items:
+            translation = translations.get(str(item.review_id))
+            if translation and translation.get('title') is not None and translation.get('comment') is not None:
+                item.translated_review_title = translation['title'].strip()
+                item.translated_review_comment = translation['comment'].strip()
+                item.translated = True
+            elif not item.translated:
+                logging.error(f"Failed to translate review: {item.review_id}")
+        return items
@@ -24,14 +24,14 @@ class TranslationPipeline:
         pass
 
     def process_item(self, item, spider):
-        combined_text = "{} [SEP] {}".format(item['title'], item['comment'])
+        combined_text = "{} [SEP] {}".format(item.title, item.comment)
         translated_text = self.client.translate_japanese_concurrently(combined_text)
         translated_title, translated_content = translated_text.split("[SEP]")
         if translated_title and translated_content:
-            item['translated_review_title'] = translated_title
-            item['translated_review_comment'] = translated_content
+            item.translated_review_title = translated_title
+            item.translated_review_comment = translated_content
         return item
 
 
     def combine_title_and_comments(self, item):
-        return f"{item['review_title']} [SEP] {item['review_content']}"
+        return f"{item.title} [SEP] {item.comment}"
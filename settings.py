@@ -45,20 +45,47 @@ ROBOTSTXT_OBEY = True
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 SPIDER_MIDDLEWARES = {
     "uniqloReview.middlewares.UniqloReviewSpiderMiddleware": 543,
+    # closest to the spider, so it times the callbacks alone
+    "uniqloReview.middlewares.CallbackTimingMiddleware": 950,
+    "uniqloReview.middlewares.CallbackProfilingMiddleware": 940,
 }
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
-    "uniqloReview.middlewares.UniqloReviewDownloaderMiddleware": 543,
     "uniqloReview.middlewares.CheckDuplicatesMiddleware": 542,
+    # owns the retries, replacing Scrapy's RetryMiddleware at the same position
+    "scrapy.downloadermiddlewares.retry.RetryMiddleware": None,
+    "uniqloReview.middlewares.AdaptiveRetryMiddleware": 550,
+    # refreshes the cached response after a 304, in place of Scrapy's HttpCacheMiddleware
+    "scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware": None,
+    "uniqloReview.httpcache.UniqloHttpCacheMiddleware": 900,
 }
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-# }
+EXTENSIONS = {
+   # "scrapy.extensions.telnet.TelnetConsole": None,
+   "uniqloReview.extensions.StageMetricsExtension": 500,
+   "uniqloReview.extensions.ProfilingExtension": 510,
+}
+
+# Latency histograms per stage (download, callbacks, translation requests and retries, Mongo writes)
+# and queue depths sampled every STAGE_METRICS_INTERVAL seconds, kept in the stats as stage_latency/*
+# and queue_depth/*. The snapshot is written to STAGE_METRICS_FILE (%(name)s and %(shard)s are replaced)
+# at close; set STAGE_METRICS_PORT to serve it in the Prometheus text format on STAGE_METRICS_HOST
+STAGE_METRICS_ENABLED = False
+STAGE_METRICS_INTERVAL = 1.0
+STAGE_METRICS_FILE = "stage_metrics/%(name)s-%(shard)s.json"
+STAGE_METRICS_PORT = None
+STAGE_METRICS_HOST = "127.0.0.1"
+
+# Profile the spider callbacks and the process_item of ReviewPipeline / ProductPipeline with cProfile,
+# only every PROFILE_SAMPLE_EVERY-th call of each, and write <spider>-<shard>-<stage>.pstats and
+# .collapsed (flamegraph) files to PROFILE_DIR at close
+PROFILE_ENABLED = False
+PROFILE_SAMPLE_EVERY = 100
+PROFILE_DIR = "profiles"
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
@@ -70,9 +97,87 @@ ITEM_PIPELINES = {
 }
 
 RETRY_TIMES = 3
-RETRY_HTTP_CODES = [500, 502, 503, 504, 522, 524, 408]
+RETRY_HTTP_CODES = [500, 502, 503, 504, 522, 524, 408, 429]
+# Seconds before a retry: the response's Retry-After, else a random delay up to
+# RETRY_BACKOFF_BASE * 2 ** (attempt - 1), both capped at RETRY_BACKOFF_MAX
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 60.0
+# Find the highest concurrency the API tolerates instead of a fixed CONCURRENT_REQUESTS_PER_DOMAIN
+# (the starting point): a 429/503 or a window of ADAPTIVE_CONCURRENCY_WINDOW responses slower than
+# ADAPTIVE_CONCURRENCY_TARGET_LATENCY seconds on average halves it, a clean window adds one.
+# CONCURRENT_REQUESTS still caps the total
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_CONCURRENCY_MIN = 1
+ADAPTIVE_CONCURRENCY_MAX = 16
+ADAPTIVE_CONCURRENCY_WINDOW = 20
+ADAPTIVE_CONCURRENCY_TARGET_LATENCY = 2.0
 STOP_ON_DUPLICATE = True
 
+# Explain the hot MongoDB queries at startup and fail on any collection scan
+# (also available as `python -m uniqloReview.utils.indexes --check`)
+MONGO_INDEX_CHECK = False
+
+# Base url of the product and review API; the benchmark points it at its local stand-in
+UNIQLO_API_BASE_URL = "https://www.uniqlo.com/jp/api/commerce/v5/ja"
+
+# Categories crawled by productSpider (ids like "1641" or paths like ",,1641"), overridable
+# with -a categories="1641;1642", and products per listing page
+PRODUCT_CATEGORIES = ["1641"]
+PRODUCT_PAGE_SIZE = 72
+
+# Review pages of one product requested in parallel once its first page reports the total
+REVIEW_PAGES_IN_FLIGHT = 8
+
+# Split the review crawl between several reviewSpider processes through a lease-based queue in the
+# review_frontier collection: each worker seeds it with its crawl plan, claims REVIEW_FRONTIER_BATCH
+# products at a time and renews their leases while crawling; leases of crashed workers expire after
+# REVIEW_FRONTIER_LEASE seconds and their products are claimed again, up to REVIEW_FRONTIER_MAX_ATTEMPTS times
+REVIEW_FRONTIER = False
+REVIEW_FRONTIER_SEED = True
+REVIEW_FRONTIER_BATCH = 20
+REVIEW_FRONTIER_LEASE = 300
+REVIEW_FRONTIER_MAX_ATTEMPTS = 3
+
+# Reviews per page requested from the reviews endpoint. With the probe enabled, the spider first
+# asks for REVIEW_PAGE_SIZE_PROBE_LIMIT reviews and uses the largest page size the endpoint honours
+REVIEW_PAGE_SIZE = 5
+REVIEW_PAGE_SIZE_PROBE = False
+REVIEW_PAGE_SIZE_PROBE_LIMIT = 100
+
+# Buffer ProductPipeline writes and flush them as one unordered bulk_write of upserts
+PRODUCT_BULK_WRITE = True
+PRODUCT_BULK_SIZE = 500
+PRODUCT_BULK_FLUSH_INTERVAL = 5.0
+
+# Buffer ReviewPipeline inserts and write them with insert_many(ordered=False)
+REVIEW_BULK_SIZE = 500
+REVIEW_BULK_FLUSH_INTERVAL = 5.0
+# Load the ids of the stored reviews when the spider opens (8 bytes per id) and drop known reviews
+# before they are translated or written
+REVIEW_ID_PRELOAD = True
+
+# Translate reviews in ReviewPipeline while crawling. Set to False to store them untranslated at full
+# crawl speed and translate them separately with `python -m uniqloReview.utils.translation_backfill`
+# (which also picks up the reviews whose translation failed during a crawl)
+TRANSLATE_DURING_CRAWL = True
+# Maximum number of review translations in flight; they run in the reactor thread pool,
+# so keep REACTOR_THREADPOOL_MAXSIZE at least as large
+TRANSLATION_CONCURRENCY = 16
+REACTOR_THREADPOOL_MAXSIZE = 20
+# Reviews are translated several per request; a batch is sent once it reaches the token budget
+# or the review count, or after the interval when reviews stop coming in
+TRANSLATION_BATCH_TOKENS = 3000
+TRANSLATION_BATCH_SIZE = 20
+TRANSLATION_BATCH_INTERVAL = 2.0
+# Entries kept in the in-process LRU in front of the persistent translations collection
+TRANSLATION_CACHE_SIZE = 10000
+# OpenAI quota for the API key, the 60 requests per minute the crawler always kept to; raise them to
+# your account's limits. Point OPENAI_RATE_LIMIT_FILE at a shared local file to split the quota
+# between several crawler processes
+OPENAI_REQUESTS_PER_MINUTE = 60
+OPENAI_TOKENS_PER_MINUTE = 60000
+OPENAI_RATE_LIMIT_FILE = None
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = True
@@ -88,11 +193,21 @@ STOP_ON_DUPLICATE = True
 
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-# HTTPCACHE_ENABLED = True
-# HTTPCACHE_EXPIRATION_SECS = 0
-# HTTPCACHE_DIR = "httpcache"
-# HTTPCACHE_IGNORE_HTTP_CODES = []
-# HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+HTTPCACHE_ENABLED = True
+HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_DIR = "httpcache"
+HTTPCACHE_POLICY = "uniqloReview.httpcache.UniqloApiCachePolicy"
+HTTPCACHE_STORAGE = "uniqloReview.httpcache.SqliteCacheStorage"
+# Seconds a cached API response is served without asking the server, by url pattern (first match wins);
+# once stale it is revalidated with If-None-Match / If-Modified-Since where possible, and a 304 starts
+# the TTL over. Review pages are addressed by offset from the newest review, so every new review shifts
+# all of them: they are always revalidated, and only stored when the API sends an ETag or Last-Modified
+# to revalidate them with. Urls matching no pattern get UNIQLO_HTTPCACHE_DEFAULT_TTL, None to not cache them
+UNIQLO_HTTPCACHE_TTLS = [
+    (r"/products\?", 6 * 3600),
+    (r"/reviews\?", 0),
+]
+UNIQLO_HTTPCACHE_DEFAULT_TTL = None
 
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
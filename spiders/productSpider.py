@@ -1,13 +1,15 @@
 import scrapy
 import pymongo, pymongo.errors
+from scrapy.downloadermiddlewares.retry import get_retry_request
 from scrapy.exceptions import CloseSpider
 from dotenv import load_dotenv
 
 
 import os
-import json
+from urllib.parse import quote
 from ..items import ProductItem
 from ..utils.utils import Utils
+from ..utils.payloads import DECODE_ERRORS, Image, Prices, Product, Rating, decode_listing
 
 # class ProductSpiderSpider(scrapy.Spider):
 #     name = 'productSpider'
@@ -139,8 +141,44 @@ from ..utils.utils import Utils
 class ProductSpider(scrapy.Spider):
     name = 'productSpider'
     allowed_domains = ['www.uniqlo.com']
-    start_urls = [
-        "https://www.uniqlo.com/jp/api/commerce/v5/ja/products?path=%2C%2C1641&categoryId=1641&offset=0&limit=72&httpFailure=true"]
+    default_categories = ['1641']
+
+    def __init__(self, categories=None, shard=0, shards=1, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # products are split between the processes started with -a shard=i -a shards=n
+        self.shard, self.shards = Utils.parse_shard(shard, shards)
+        # category ids or paths, separated by ';' when passed with -a categories=...
+        self.categories = [category.strip() for category in categories.split(';') if category.strip()] \
+            if isinstance(categories, str) else categories
+        # products listed in several categories are only yielded once
+        self.seen_product_ids = set()
+
+    def start_requests(self):
+        categories = self.categories or self.settings.getlist('PRODUCT_CATEGORIES') or self.default_categories
+        for category in categories:
+            path, category_id = self.parse_category(category)
+            yield scrapy.Request(self.listing_url(path, category_id, 0), callback=self.parse,
+                                 meta={'path': path, 'category_id': category_id})
+
+    @staticmethod
+    def parse_category(category):
+        """
+        Turn a category id ('1641') or path (',,1641') into the path and category id of the listing API
+        :param category: category id or path
+        :return: tuple of (path, category_id)
+        """
+        category = str(category)
+        if ',' in category:
+            return category, category.rstrip(',').split(',')[-1]
+        return f',,{category}', category
+
+    @property
+    def api_base_url(self):
+        return self.settings.get('UNIQLO_API_BASE_URL') or Utils.API_BASE_URL
+
+    def listing_url(self, path, category_id, offset):
+        limit = self.settings.getint('PRODUCT_PAGE_SIZE', 72)
+        return f"{self.api_base_url}/products?path={quote(path)}&categoryId={category_id}&offset={offset}&limit={limit}&httpFailure=true"
 
     def parse(self, response):
         """
@@ -149,28 +187,60 @@ class ProductSpider(scrapy.Spider):
         :return: json data of the products
         """
 
-        data = json.loads(response.text)
-        products = data.get('result', {}).get('items', {})
-
-        for product in products:
+        try:
+            page = decode_listing(response.body)
+        except DECODE_ERRORS:
+            # a truncated or garbled body, retried within the same RETRY_TIMES budget as HTTP errors
+            retry_request = get_retry_request(response.request, spider=self, reason='invalid_json')
+            if retry_request is not None:
+                yield retry_request
+            else:
+                self.logger.error(f'Failed to decode JSON of {response.url}')
+            return
+        for product in page.items:
+            # every shard reads every listing page, a product listed in several categories is only
+            # yielded by the shard owning it
+            if product.product_id in self.seen_product_ids or \
+                    not Utils.in_shard(product.product_id, self.shard, self.shards):
+                continue
+            self.seen_product_ids.add(product.product_id)
             yield self.extract_product_data(product)
 
-    def extract_product_data(self, product: dict) -> ProductItem:
+        yield from self.handles_pagination(page, response)
+
+    def handles_pagination(self, page, response):
+        """
+        Request every other page of the category at once after its first page reports the total
+        """
+        pagination = page.pagination
+        if pagination.offset != 0 or 'path' not in response.meta:
+            return
+        total = pagination.total or 0
+        limit = self.settings.getint('PRODUCT_PAGE_SIZE', 72)
+        path, category_id = response.meta['path'], response.meta['category_id']
+        for offset in range(limit, total, limit):
+            yield scrapy.Request(self.listing_url(path, category_id, offset), callback=self.parse,
+                                 meta={'path': path, 'category_id': category_id})
 
+    def extract_product_data(self, product: Product) -> ProductItem:
+        rating = product.rating or Rating()
+        images = product.images.main if product.images else {}
         return ProductItem(
-            product_id=product.get('productId'),
-            item_name=product.get('name'),
+            product_id=product.product_id,
+            item_name=product.name,
             prices=self.get_final_price(product),
-            color_names=[color.get('name') for color in product.get('colors', [])],
-            rating=product.get('rating', {}).get('average'),
-            review_count=product.get('rating', {}).get('count'),
-            product_image=next(iter(product.get('images', {}).get('main', {}).values()), {}).get('image', 'No Image'),
-            url=f"https://www.uniqlo.com/jp/api/commerce/v5/ja/products/{product.get('productId')}/reviews?limit=5&offset=0&sort=submission_time&httpFailure=true"
+            color_names=[color.name for color in product.colors],
+            rating=rating.average,
+            review_count=rating.count,
+            product_image=next(iter(images.values()), Image()).image or 'No Image',
+            url=Utils.review_url(product.product_id, limit=self.settings.getint('REVIEW_PAGE_SIZE', 5),
+                                 base_url=self.api_base_url)
         )
 
-    def get_final_price(self, product: dict) -> float:
-        base_price = product.get('prices', {}).get('base', {}).get('value')
-        promo_price = product.get('prices', {}).get('promo', {}).get('value') if product.get('prices', {}).get('promo') else None
+    def get_final_price(self, product: Product) -> float:
+        prices = product.prices or Prices()
+        base_price = prices.base.value if prices.base else None
+        promo_price = prices.promo.value if prices.promo else None
         final_price = promo_price if promo_price else base_price
         return final_price
 
@@ -1,46 +1,186 @@
 import scrapy
-import json
 import os
-from scrapy.exceptions import CloseSpider
+from scrapy import signals
+from scrapy.downloadermiddlewares.retry import get_retry_request
+from scrapy.exceptions import CloseSpider, DontCloseSpider, IgnoreRequest
 from dotenv import load_dotenv
+from twisted.internet import task
 
 from ..items import ReviewItem
 from ..utils.utils import Utils, MongoDBHandler
+from ..utils.payloads import DECODE_ERRORS, decode_reviews
+from ..utils.frontier import ReviewFrontier
 
 class ReviewScraperSpider(scrapy.Spider):
     name = "reviewSpider"
     allowed_domains = ["www.uniqlo.com"]
+    review_page_size = 5
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, shard=0, shards=1, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # products are split between the processes started with -a shard=i -a shards=n
+        self.shard, self.shards = Utils.parse_shard(shard, shards)
         self.reviews_scraped = 0
         self.max_reviews_to_scrape = int(os.getenv('MAX_REVIEWS_TO_SCRAPE', 3))
         self.setup_mongodb()
         self.latest_scraped_time = self.mongodb_handler.fetch_latest_scraped_time('reviews')
-        self.start_urls = self.mongodb_handler.fetch_start_urls('products')
-        self.duplicates_found = False
+        self.crawl_plan = []
+        # newest review already stored per product; pagination stops once it is reached
+        self.high_water_marks = self.mongodb_handler.fetch_review_high_water_marks('products')
+        self.new_high_water_marks = {}
+        self.products_done = set()
+        # a product's mark only moves once every review yielded for it is stored, see review_stored
+        self.unconfirmed_reviews = {}
+        self.products_failed = set()
+        # products left unfinished by MAX_REVIEWS_TO_SCRAPE
+        self.products_capped = set()
+        # product_id -> pagination progress, see handles_pagination
+        self.product_pages = {}
         self.force_crawling = os.getenv('FORCE_CRAWLING', False)
-        self.max_retries = int(os.getenv('MAX_RETRIES', 3))
+        # shared work queue when several workers split the crawl, see REVIEW_FRONTIER
+        self.frontier = None
+        self.claimed = set()
+        self.lease_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        if os.getenv('FORCE_DROP_COLLECTION') == 'True':
+            # with several workers one starting late would drop the reviews the others already stored,
+            # the launcher drops the collection once before starting them instead
+            if spider.shards > 1 or crawler.settings.getbool('REVIEW_FRONTIER'):
+                spider.logger.warning('FORCE_DROP_COLLECTION is ignored by sharded and frontier workers')
+            else:
+                spider.force_to_drop_collection()
+                spider.latest_scraped_time = None
+                spider.high_water_marks = {}
+        return spider
 
     def setup_mongodb(self):
         load_dotenv()
         mongo_url = os.getenv('MONGO_URL')
         if not mongo_url:
             raise CloseSpider('MONGO_URL is not set')
-        self.mongodb_handler = MongoDBHandler(mongo_url)
-        if os.getenv('FORCE_DROP_COLLECTION') == 'True':
-            self.force_to_drop_collection()
+        self.mongodb_handler = MongoDBHandler(mongo_url, os.getenv('MONGO_DB', 'uniqlo'))
+
+    @property
+    def api_base_url(self):
+        return self.settings.get('UNIQLO_API_BASE_URL') or Utils.API_BASE_URL
 
     def start_requests(self):
         # get the review_count from the product collection
+        if self.settings.getbool('REVIEW_FRONTIER'):
+            # other workers write reviews all along, so the latest scraped time says nothing here
+            yield from self.frontier_start_requests()
+            return
         if self.latest_scraped_time and Utils.get_datetime() - self.latest_scraped_time < 5:
             self.logger.info('Latest reviews are less than a day ago. Exiting spider.')
             return
-        for url in self.start_urls:
-            yield scrapy.Request(url, callback=self.parse_review, errback=self.errback_httpbin, meta={'retry_times': 0})
+        self.review_page_size = self.settings.getint('REVIEW_PAGE_SIZE', self.review_page_size)
+        # only products whose listing review_count is ahead of the stored reviews need crawling
+        self.crawl_plan = [
+            plan for plan in self.mongodb_handler.fetch_review_crawl_plan(
+                self.review_page_size, only_changed=not self.force_crawling)
+            if Utils.in_shard(plan['product_id'], self.shard, self.shards)
+        ]
+        self.logger.info(f'{len(self.crawl_plan)} products have new reviews')
+        if self.settings.getbool('REVIEW_PAGE_SIZE_PROBE') and self.crawl_plan:
+            # the real start requests are sent once the probe has settled the page size
+            product_id = self.crawl_plan[0]['product_id']
+            probe_limit = self.settings.getint('REVIEW_PAGE_SIZE_PROBE_LIMIT', 100)
+            probe_url = Utils.review_url(product_id, limit=probe_limit, base_url=self.api_base_url)
+            yield scrapy.Request(probe_url, callback=self.parse_probe,
+                                 errback=self.errback_probe, dont_filter=True, meta={'probe_limit': probe_limit})
+            return
+        yield from self.product_start_requests()
+
+    def frontier_start_requests(self):
+        """
+        Seed the shared frontier with this worker's crawl plan, then crawl the products it claims
+        """
+        self.review_page_size = self.settings.getint('REVIEW_PAGE_SIZE', self.review_page_size)
+        lease_seconds = self.settings.getint('REVIEW_FRONTIER_LEASE', 300)
+        self.frontier = ReviewFrontier(
+            self.mongodb_handler.db.review_frontier,
+            lease_seconds=lease_seconds,
+            max_attempts=self.settings.getint('REVIEW_FRONTIER_MAX_ATTEMPTS', 3),
+        )
+        if self.settings.getbool('REVIEW_FRONTIER_SEED', True):
+            crawl_plan = self.mongodb_handler.fetch_review_crawl_plan(
+                self.review_page_size, only_changed=not self.force_crawling)
+            self.logger.info(f'Queued {self.frontier.seed(crawl_plan)} of {len(crawl_plan)} products with new reviews')
+        # renew well before the leases run out
+        self.lease_loop = task.LoopingCall(self.renew_leases)
+        self.lease_loop.start(max(1, lease_seconds / 3), now=False)
+        yield from self.claim_products()
+
+    def claim_products(self):
+        self.crawl_plan = self.frontier.claim(self.settings.getint('REVIEW_FRONTIER_BATCH', 20))
+        self.claimed.update(plan['product_id'] for plan in self.crawl_plan)
+        self.logger.info(f'Worker {self.frontier.worker_id} claimed {len(self.crawl_plan)} products')
+        yield from self.product_start_requests()
+
+    def renew_leases(self):
+        self.frontier.renew(self.claimed)
+
+    def spider_idle(self, spider):
+        """
+        Once the claimed products are crawled, hand back the ones that couldn't be finished and claim
+        the next batch; the spider only closes when the frontier is empty
+        """
+        if self.frontier is None:
+            return
+        self.frontier.release(self.claimed)
+        self.claimed.clear()
+        requests = list(self.claim_products())
+        if not requests:
+            return
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        raise DontCloseSpider
+
+    def product_start_requests(self):
+        for plan in self.crawl_plan:
+            product_id = plan['product_id']
+            # only the pages holding the new reviews are crawled, the first one is requested here
+            self.product_pages[product_id] = {
+                'total': plan['new_reviews'],
+                'step': self.review_page_size,
+                'next_offset': self.review_page_size,
+                'stop_offset': float('inf'),
+                'pending': {0},
+            }
+            yield scrapy.Request(Utils.review_url(product_id, limit=self.review_page_size, base_url=self.api_base_url),
+                                 callback=self.parse_review, errback=self.errback_httpbin,
+                                 meta={'product_id': product_id, 'offset': 0, 'limit': self.review_page_size})
+
+    def parse_probe(self, response):
+        """
+        Find the largest page size the reviews endpoint honours from a request with a large limit
+        """
+        try:
+            page = decode_reviews(response.body)
+        except DECODE_ERRORS:
+            self.logger.error('Failed to decode the page size probe, keeping the configured page size')
+            yield from self.product_start_requests()
+            return
+        probe_limit = response.meta['probe_limit']
+        page_size = self.served_page_size(page, probe_limit) if page.reviews else None
+        if page_size and page_size > self.review_page_size:
+            self.logger.info(f'Review page size probe: using limit={page_size} instead of {self.review_page_size}')
+            self.review_page_size = page_size
+        else:
+            self.logger.info(f'Review page size probe was inconclusive, keeping limit={self.review_page_size}')
+        yield from self.product_start_requests()
+
+    def errback_probe(self, failure):
+        self.logger.error(f'Review page size probe failed, keeping limit={self.review_page_size}')
+        yield from self.product_start_requests()
 
     def force_to_drop_collection(self):
         self.mongodb_handler.drop_collection('reviews')
+        self.mongodb_handler.clear_review_high_water_marks('products')
         self.logger.info('Dropped the reviews collection')
         return True
 
@@ -51,29 +191,28 @@ class ReviewScraperSpider(scrapy.Spider):
             self.logger.error('Product ID extraction failed')
             return
         try:
-            data = json.loads(response.text)
-            yield from (
-                self.process_reviews(data, product_id))
-            yield from self.handles_pagination(data, product_id)
-        except json.JSONDecodeError:
-            self.logger.error('Failed to decode JSON')
-            retry_times = response.meta.get('retry_times', 0) + 1
-            if retry_times <= self.max_retries:
-                self.logger.warning(f'Retrying {response.url} due to JSONDecodeError ({retry_times}/{self.max_retries})')
-                yield response.request.replace(dont_filter=True, meta={'retry_times': retry_times})
+            page = decode_reviews(response.body)
+        except DECODE_ERRORS:
+            # a truncated or garbled body, retried within the same RETRY_TIMES budget as HTTP errors
+            retry_request = get_retry_request(response.request, spider=self, reason='invalid_json')
+            if retry_request is not None:
+                yield retry_request
             else:
-                self.logger.error(f'Failed to decode JSON after {retry_times} retries')
+                self.logger.error(f'Failed to decode JSON of {response.url}')
+            return
+        self.track_pagination(page, product_id, response.meta.get('limit', self.review_page_size))
+        yield from self.process_reviews(page, product_id)
+        yield from self.handles_pagination(page, product_id)
 
     def errback_httpbin(self, failure):
         request = failure.request
-        product_id = self.extract_product_id_from_url(request.url)
-        self.logger.error(f'Failed to fetch {request.url}')
-        retry_times = request.meta.get('retry_times', 0) + 1
-        if retry_times <= self.max_retries:
-            self.logger.warning(f'Retrying {request.url} due to JSONDecodeError ({retry_times}/{self.max_retries})')
-            yield request.replace(dont_filter=True, meta={'retry_times': retry_times})
-        else:
-            self.logger.error(f'Failed to decode JSON after {retry_times} retries')
+        if failure.check(IgnoreRequest):
+            # dropped on purpose, e.g. the page is past the product's already-known reviews
+            return
+        # AdaptiveRetryMiddleware has already retried the request RETRY_TIMES times; the page stays
+        # pending, so the product is not marked done and its reviews are crawled again next run
+        self.logger.error(f'Failed to fetch {request.url} after {request.meta.get("retry_times", 0)} retries: '
+                          f'{failure.getErrorMessage()}')
 
     def extract_product_id_from_url(self, url):
         self.parts = url.split('/')
@@ -84,56 +223,216 @@ class ReviewScraperSpider(scrapy.Spider):
             self.logger.error('Product ID not found in the URL')
             return None
 
-    def process_reviews(self, data, product_id):
-        reviews = data.get('result', {}).get('reviews', [])
+    def process_reviews(self, page, product_id):
+        reviews = page.reviews
+        offset = page.pagination.offset
         for review in reviews:
-            if self.stop_crawling() or self.reviews_scraped >= self.max_reviews_to_scrape:
+            if self.is_known_review(review, product_id):
+                # pages after this one only hold older reviews
+                self.stop_pagination(product_id, offset + self.page_step(product_id))
                 break
+            if self.reviews_scraped >= self.max_reviews_to_scrape:
+                # the reviews left out keep the product unfinished, so its mark stays where it was
+                self.products_capped.add(product_id)
+                self.stop_pagination(product_id)
+                break
+            if offset == 0 and product_id not in self.new_high_water_marks:
+                # reviews are sorted by submission_time, so the first one yielded is the newest
+                self.new_high_water_marks[product_id] = {
+                    'created_date': review.create_date,
+                    'review_id': review.review_id,
+                }
             self.reviews_scraped += 1
+            self.unconfirmed_reviews.setdefault(product_id, set()).add(review.review_id)
             yield self.extract_review_data(review, product_id)
 
+    def review_stored(self, product_id, review_id):
+        """
+        Called by ReviewPipeline once a yielded review is in the reviews collection (or already was)
+        """
+        self.unconfirmed_reviews.get(product_id, set()).discard(review_id)
+
+    def review_failed(self, product_id, review_id):
+        """
+        Called by ReviewPipeline when a yielded review could not be stored; the product keeps its mark
+        """
+        self.products_failed.add(product_id)
+
+    def can_move_high_water_mark(self, product_id):
+        """
+        Check that every review newer than the product's stored mark was yielded and stored: its pages
+        were crawled down to the mark (or the last page), without the cap cutting it short
+        """
+        return (product_id in self.products_done
+                and product_id not in self.products_capped
+                and product_id not in self.products_failed
+                and not self.unconfirmed_reviews.get(product_id))
+
+    def is_known_review(self, review, product_id):
+        """
+        Check if the review is at or below the product's high-water mark
+        :param review: Review payload from the response
+        :param product_id: the product id
+        :return: True if the review is already stored
+        """
+        if self.force_crawling:
+            return False
+        high_water_mark = self.high_water_marks.get(product_id)
+        if not high_water_mark:
+            return False
+        if review.review_id == high_water_mark.get('review_id'):
+            return True
+        created_date = review.create_date
+        return bool(created_date and high_water_mark.get('created_date')
+                    and created_date < high_water_mark['created_date'])
+
+    def stop_pagination(self, product_id, offset=None):
+        """
+        Stop scheduling pages of the product from the given offset on. Pages before it still get
+        parsed, since with parallel pagination they can arrive after the page that hit known reviews.
+        :param product_id: the product id
+        :param offset: the first offset not to crawl, or None to stop after the pages already scheduled
+        """
+        pages = self.product_pages.get(product_id)
+        if pages is None:
+            return
+        if offset is None:
+            offset = pages['next_offset']
+        pages['stop_offset'] = min(pages['stop_offset'], offset)
+        self.check_product_done(product_id)
+
+    def skip_page(self, product_id, offset):
+        """
+        Check if a scheduled page is past the point where the product's crawl stopped
+        """
+        if self.force_crawling:
+            return False
+        if product_id in self.products_done:
+            return True
+        pages = self.product_pages.get(product_id)
+        return pages is not None and offset is not None and offset >= pages['stop_offset']
+
+    def check_product_done(self, product_id):
+        pages = self.product_pages[product_id]
+        end_offset = min(pages['total'], pages['stop_offset'])
+        if pages['next_offset'] >= end_offset and not any(offset < end_offset for offset in pages['pending']):
+            self.finish_product(product_id)
+
+    def finish_product(self, product_id):
+        """
+        Mark the product as completely crawled; its new high-water mark is stored when the spider closes,
+        after the pipelines have written the reviews
+        :param product_id: the product id
+        """
+        self.products_done.add(product_id)
+        if product_id in self.products_capped:
+            # released at close, so another run crawls it again
+            return
+        if product_id in self.claimed:
+            self.claimed.discard(product_id)
+            self.frontier.complete(product_id)
+
     def extract_review_data(self, review, product_id):
         return ReviewItem(
             product_id=product_id,
-            review_id=review.get('reviewId'),
-            purchased_size=review.get('purchasedSize'),
-            comment=review.get('comment'),
-            fit=review.get('fit'),
-            gender=review.get('gender'),
-            location=review.get('location'),
-            review_name=review.get('name'),
-            rate=review.get('rate'),
-            title=review.get('title'),
-            created_date=review.get('createDate'),
+            review_id=review.review_id,
+            purchased_size=review.purchased_size,
+            comment=review.comment,
+            fit=review.fit,
+            gender=review.gender,
+            location=review.location,
+            review_name=review.name,
+            rate=review.rate,
+            title=review.title,
+            created_date=review.create_date,
             scraped_time=Utils.get_datetime()
         )
 
-    def handles_pagination(self, data, product_id):
-        pagination = data.get('result', {}).get('pagination', {})
-        total_reviews = pagination.get('total', 0)
-        offset = pagination.get('offset', 0) + 5
+    def served_page_size(self, page, requested_limit):
+        """
+        The number of reviews the endpoint serves per page. A page shorter than the limit that isn't the
+        product's last page means the limit was capped, whatever limit the response echoes back.
+        :param page: the decoded reviews page
+        :param requested_limit: the limit of the request
+        :return: the page size
+        """
+        pagination = page.pagination
+        count = len(page.reviews)
+        limit = min(pagination.limit or requested_limit, requested_limit)
+        if 0 < count < limit and (pagination.offset or 0) + count < (pagination.total or 0):
+            return count
+        return limit
 
-        if offset < total_reviews and product_id is not None:
-            next_page = f'https://www.uniqlo.com/jp/api/commerce/v5/ja/products/{product_id}/reviews?limit=5&offset={offset}&sort=submission_time&httpFailure=true'
-            yield scrapy.Request(next_page, callback=self.parse_review, meta={'product_id': product_id})
+    def track_pagination(self, page, product_id, requested_limit):
+        """
+        Record the product's total from its first page and mark the parsed page as no longer in flight.
+        When the page holds fewer reviews than requested, later pages step by the served size, and the
+        reviews it skipped are queued as a gap page unless the next page hasn't been scheduled yet.
+        """
+        pagination = page.pagination
+        offset = pagination.offset or 0
+        step = self.served_page_size(page, requested_limit)
+        pages = self.product_pages.setdefault(product_id, {
+            'total': pagination.total or 0,
+            'step': step,
+            'next_offset': offset + requested_limit,
+            'stop_offset': float('inf'),
+            'pending': set(),
+        })
+        if pagination.total is not None:
+            pages['total'] = min(pages['total'], pagination.total)
+        pages['pending'].discard(offset)
+        if step < requested_limit:
+            pages['step'] = min(pages['step'], step)
+            self.review_page_size = min(self.review_page_size, step)
+            if pages['next_offset'] == offset + requested_limit:
+                pages['next_offset'] = offset + step
+            else:
+                gap_offset = offset + step
+                pages.setdefault('gaps', []).append((gap_offset, requested_limit - step))
+                pages['pending'].add(gap_offset)
 
-    def check_reviews_count(self, product_id ):
-        # Check if the reviews are already scraped
-        expected_review_count = self.mongodb_handler.fetch_product_with_review_counts(product_id)
-        reviews_count_in_db = self.mongodb_handler.count_reviews_in_db(product_id)
+    def page_step(self, product_id):
+        pages = self.product_pages.get(product_id)
+        return pages['step'] if pages else self.review_page_size
 
-        if reviews_count_in_db >= expected_review_count:
-            return True
-        else:
-            return False
+    def handles_pagination(self, page, product_id):
+        """
+        Schedule the product's next pages. Once the first page reports the total, pages are requested
+        in parallel, keeping at most REVIEW_PAGES_IN_FLIGHT pages of one product in flight.
+        """
+        pages = self.product_pages.get(product_id)
+        if pages is None or product_id in self.products_done:
+            return
 
-    def close_spider(self, spider):
-        self.mongodb_handler.close_client()
+        # reviews a short page left out, already counted as pending
+        for gap_offset, gap_limit in pages.pop('gaps', []):
+            if gap_offset < pages['stop_offset']:
+                yield self.review_request(product_id, gap_offset, gap_limit)
+        pages_in_flight = self.settings.getint('REVIEW_PAGES_IN_FLIGHT', 8)
+        while pages['next_offset'] < min(pages['total'], pages['stop_offset']) and \
+                len(pages['pending']) < pages_in_flight:
+            next_offset = pages['next_offset']
+            pages['next_offset'] += pages['step']
+            pages['pending'].add(next_offset)
+            yield self.review_request(product_id, next_offset, pages['step'])
+        self.check_product_done(product_id)
 
-    def stop_crawling(self):
-        if self.force_crawling:
-            return False
-        if self.check_reviews_count or self.duplicates_found:
-            return True
+    def review_request(self, product_id, offset, limit):
+        return scrapy.Request(Utils.review_url(product_id, offset=offset, limit=limit, base_url=self.api_base_url),
+                              callback=self.parse_review, errback=self.errback_httpbin,
+                              meta={'product_id': product_id, 'offset': offset, 'limit': limit})
+
+    def closed(self, reason):
+        if self.frontier is not None:
+            if self.lease_loop and self.lease_loop.running:
+                self.lease_loop.stop()
+            self.frontier.release(self.claimed)
+        # the pipelines have flushed by now, so the stored reviews are all confirmed
+        self.mongodb_handler.save_review_high_water_marks({
+            product_id: mark for product_id, mark in self.new_high_water_marks.items()
+            if self.can_move_high_water_mark(product_id)
+        }, 'products')
+        self.mongodb_handler.close_client()
 
 
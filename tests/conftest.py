@@ -0,0 +1,99 @@
+import json
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from scrapy import Request
+from scrapy.http import TextResponse
+from scrapy.utils.test import get_crawler
+
+from ..spiders.reviewScraper import ReviewScraperSpider
+from ..utils import utils as utils_module
+from ..utils.price_history import PRICE_HISTORY_COLLECTION
+
+MONGO_DB = 'uniqlo_test'
+
+
+@pytest.fixture
+def mongo_client(monkeypatch):
+    """
+    One mongomock client handed out to every MongoClient the spiders and pipelines open
+    """
+    client = mongomock.MongoClient()
+    # mongomock has no time-series collections, a plain one stands in for price_history
+    client[MONGO_DB].create_collection(PRICE_HISTORY_COLLECTION)
+    monkeypatch.setattr(utils_module, 'MongoClient', lambda *args, **kwargs: client)
+    monkeypatch.setattr('pymongo.MongoClient', lambda *args, **kwargs: client)
+    monkeypatch.setenv('MONGO_URL', 'mongodb://localhost:27017')
+    monkeypatch.setenv('MONGO_DB', MONGO_DB)
+    # values a local .env could otherwise provide
+    monkeypatch.setenv('FORCE_DROP_COLLECTION', 'False')
+    monkeypatch.setenv('FORCE_CRAWLING', '')
+    monkeypatch.setenv('MAX_REVIEWS_TO_SCRAPE', '1000')
+    return client
+
+
+@pytest.fixture
+def db(mongo_client):
+    return mongo_client[MONGO_DB]
+
+
+@pytest.fixture
+def make_review_spider(mongo_client):
+    def make(settings=None, **kwargs):
+        crawler = get_crawler(ReviewScraperSpider, settings)
+        return ReviewScraperSpider.from_crawler(crawler, **kwargs)
+    return make
+
+
+def make_reviews(count, newest=datetime(2024, 5, 1), prefix=0):
+    """
+    Review payloads of the reviews endpoint, newest first like the API sorts them
+    """
+    return [
+        {
+            'reviewId': prefix + count - index,
+            'createDate': (newest - timedelta(hours=index)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'title': f'title {prefix + count - index}',
+            'comment': f'comment {prefix + count - index}',
+        }
+        for index in range(count)
+    ]
+
+
+def high_water_mark(review):
+    return {'created_date': review['createDate'], 'review_id': review['reviewId']}
+
+
+def review_response(request, reviews, max_page_size=None):
+    """
+    Answer a review page request from the product's reviews; with max_page_size the endpoint serves at
+    most that many reviews but still echoes the requested limit
+    """
+    offset, limit = request.meta['offset'], request.meta['limit']
+    page = reviews[offset:offset + min(limit, max_page_size or limit)]
+    body = json.dumps({'result': {
+        'reviews': page,
+        'pagination': {'offset': offset, 'total': len(reviews), 'count': len(page), 'limit': limit},
+    }})
+    return TextResponse(request.url, body=body.encode('utf-8'), encoding='utf-8', request=request)
+
+
+def crawl_reviews(spider, reviews_by_product, max_page_size=None):
+    """
+    Run the spider's crawl plan against the given reviews, dropping the pages CheckDuplicatesMiddleware
+    would drop
+    :return: tuple of (yielded items, offsets requested per product)
+    """
+    requests = list(spider.product_start_requests())
+    items, requested = [], {}
+    while requests:
+        request = requests.pop(0)
+        product_id = request.meta['product_id']
+        if spider.skip_page(product_id, request.meta['offset']):
+            continue
+        requested.setdefault(product_id, []).append((request.meta['offset'], request.meta['limit']))
+        response = review_response(request, reviews_by_product[product_id], max_page_size)
+        for output in spider.parse_review(response):
+            (requests if isinstance(output, Request) else items).append(output)
+    return items, requested
@@ -0,0 +1,106 @@
+from datetime import timedelta
+
+import pytest
+
+from ..utils.frontier import ReviewFrontier
+
+PLAN = [{'product_id': f'P{index}', 'new_reviews': index} for index in range(1, 6)]
+
+
+@pytest.fixture
+def collection(db):
+    return db.review_frontier
+
+
+def worker(collection, name, **kwargs):
+    return ReviewFrontier(collection, worker_id=name, lease_seconds=60, **kwargs)
+
+
+def state(collection, product_id):
+    return collection.find_one({'_id': product_id})['state']
+
+
+def expire(collection, product_ids):
+    collection.update_many({'_id': {'$in': list(product_ids)}},
+                           {'$set': {'lease_expires': ReviewFrontier.now() - timedelta(seconds=1)}})
+
+
+def claimed_ids(claimed):
+    return [plan['product_id'] for plan in claimed]
+
+
+def test_workers_claim_disjoint_products_most_reviews_first(collection):
+    first, second = worker(collection, 'a'), worker(collection, 'b')
+    assert first.seed(PLAN) == 5
+    assert second.seed(PLAN) == 0
+
+    assert claimed_ids(first.claim(2)) == ['P5', 'P4']
+    assert claimed_ids(second.claim(10)) == ['P3', 'P2', 'P1']
+    assert first.claim(1) == []
+
+
+def test_expired_lease_is_claimed_again(collection):
+    first, second = worker(collection, 'a'), worker(collection, 'b')
+    first.seed(PLAN)
+    first.claim(5)
+    expire(collection, ['P3'])
+
+    assert second.claim(5) == [{'product_id': 'P3', 'new_reviews': 3}]
+    document = collection.find_one({'_id': 'P3'})
+    assert (document['lease_owner'], document['attempts']) == ('b', 2)
+    # the first worker lost the lease, its completion is ignored
+    first.complete('P3')
+    assert state(collection, 'P3') == 'leased'
+
+
+def test_renewed_lease_is_not_claimed(collection):
+    first, second = worker(collection, 'a'), worker(collection, 'b')
+    first.seed(PLAN)
+    first.claim(5)
+    expire(collection, ['P1', 'P2'])
+
+    first.renew(['P1'])
+
+    assert claimed_ids(second.claim(5)) == ['P2']
+
+
+def test_exhausted_expired_leases_are_marked_failed(collection):
+    first = worker(collection, 'a', max_attempts=1)
+    first.seed(PLAN[:2])
+    first.claim(2)
+    expire(collection, ['P1'])
+
+    assert worker(collection, 'b', max_attempts=1).claim(5) == []
+    assert state(collection, 'P1') == 'failed'
+    assert 'lease_owner' not in collection.find_one({'_id': 'P1'})
+    assert state(collection, 'P2') == 'leased'
+
+
+def test_release_returns_products_to_the_queue(collection):
+    first = worker(collection, 'a', max_attempts=2)
+    first.seed(PLAN[:2])
+    first.claim(2)
+
+    first.release(['P1', 'P2'])
+    assert {state(collection, product_id) for product_id in ('P1', 'P2')} == {'pending'}
+
+    assert claimed_ids(first.claim(2)) == ['P2', 'P1']
+    first.complete('P2')
+    first.release(['P1', 'P2'])
+    assert (state(collection, 'P1'), state(collection, 'P2')) == ('failed', 'done')
+    assert first.claim(2) == []
+
+
+def test_seed_requeues_finished_products(collection):
+    first = worker(collection, 'a', max_attempts=1)
+    first.seed(PLAN[:3])
+    first.claim(3)
+    first.complete('P1')
+    first.release(['P2'])
+
+    assert first.seed([{'product_id': product_id, 'new_reviews': 7} for product_id in ('P1', 'P2', 'P3')]) == 2
+
+    document = collection.find_one({'_id': 'P2'})
+    assert (document['state'], document['attempts'], document['new_reviews']) == ('pending', 0, 7)
+    assert state(collection, 'P3') == 'leased'
+    assert sorted(claimed_ids(first.claim(3))) == ['P1', 'P2']
@@ -0,0 +1,129 @@
+import pymongo.errors
+import pytest
+
+from ..pipelines.review_pipeline import ReviewPipeline
+from .conftest import crawl_reviews, high_water_mark, make_reviews
+
+OLD_REVIEWS = 4
+
+
+@pytest.fixture
+def product(db):
+    """
+    A product with 23 new reviews on top of the 4 stored ones, the newest of which is its mark
+    """
+    reviews = make_reviews(23 + OLD_REVIEWS)
+    db.products.insert_one({'product_id': 'P1', 'review_high_water_mark': high_water_mark(reviews[23])})
+    return reviews
+
+
+def start(spider, new_reviews=23):
+    spider.review_page_size = 5
+    spider.crawl_plan = [{'product_id': 'P1', 'new_reviews': new_reviews}]
+    return spider
+
+
+def stored_mark(db):
+    return db.products.find_one({'product_id': 'P1'})['review_high_water_mark']
+
+
+def test_pagination_stops_at_the_stored_mark(make_review_spider, product):
+    spider = start(make_review_spider())
+
+    items, requested = crawl_reviews(spider, {'P1': product})
+
+    assert [item.review_id for item in items] == [review['reviewId'] for review in product[:23]]
+    assert [offset for offset, _ in requested['P1']] == [0, 5, 10, 15, 20]
+    assert 'P1' in spider.products_done
+
+
+def test_mark_moves_to_the_newest_review_once_every_review_is_stored(make_review_spider, product, db):
+    spider = start(make_review_spider())
+    items, _ = crawl_reviews(spider, {'P1': product})
+    for item in items:
+        spider.review_stored(item.product_id, item.review_id)
+
+    spider.closed('finished')
+
+    assert stored_mark(db) == high_water_mark(product[0])
+
+
+def test_mark_stays_while_reviews_are_unconfirmed(make_review_spider, product, db):
+    spider = start(make_review_spider())
+    items, _ = crawl_reviews(spider, {'P1': product})
+    # the pipeline never confirmed the last review, e.g. its translation errored
+    for item in items[:-1]:
+        spider.review_stored(item.product_id, item.review_id)
+
+    spider.closed('finished')
+
+    assert stored_mark(db) == high_water_mark(product[23])
+
+
+def test_capped_product_keeps_its_mark(make_review_spider, product, db, monkeypatch):
+    monkeypatch.setenv('MAX_REVIEWS_TO_SCRAPE', '3')
+    spider = start(make_review_spider())
+
+    items, _ = crawl_reviews(spider, {'P1': product})
+    for item in items:
+        spider.review_stored(item.product_id, item.review_id)
+    spider.closed('finished')
+
+    assert len(items) == 3
+    assert 'P1' in spider.products_capped
+    # the 20 reviews left out are crawled again next run
+    assert stored_mark(db) == high_water_mark(product[23])
+
+
+def test_a_product_without_new_reviews_keeps_its_mark(make_review_spider, product, db):
+    spider = start(make_review_spider(), new_reviews=1)
+
+    items, _ = crawl_reviews(spider, {'P1': product[23:]})
+    spider.closed('finished')
+
+    assert items == []
+    assert stored_mark(db) == high_water_mark(product[23])
+
+
+@pytest.fixture
+def pipeline(mongo_client, db):
+    pipeline = ReviewPipeline(flush_interval=0, preload_review_ids=False, translate=False)
+    pipeline.open_spider(None)
+    # flushed by the tests, without the timer
+    pipeline.flush_interval = 3600
+    return pipeline
+
+
+def process(pipeline, spider, items):
+    for item in items:
+        pipeline.process_item(item, spider)
+    pipeline.flush(spider)
+
+
+def test_pipeline_confirms_inserted_and_duplicate_reviews(make_review_spider, product, db, pipeline):
+    spider = start(make_review_spider())
+    items, _ = crawl_reviews(spider, {'P1': product})
+    # already stored by an earlier, interrupted run
+    db.reviews.insert_one({'product_id': 'P1', 'review_id': items[0].review_id})
+
+    process(pipeline, spider, items)
+    spider.closed('finished')
+
+    assert db.reviews.count_documents({}) == 23
+    assert stored_mark(db) == high_water_mark(product[0])
+
+
+def test_failed_insert_keeps_the_mark(make_review_spider, product, db, pipeline, monkeypatch):
+    spider = start(make_review_spider())
+    items, _ = crawl_reviews(spider, {'P1': product})
+
+    def insert_many(documents, ordered=True):
+        raise pymongo.errors.BulkWriteError({'writeErrors': [{'index': 3, 'code': 121, 'errmsg': 'invalid'}],
+                                             'nInserted': len(documents) - 1})
+    monkeypatch.setattr(pipeline.reviews_collection, 'insert_many', insert_many)
+
+    process(pipeline, spider, items)
+    spider.closed('finished')
+
+    assert 'P1' in spider.products_failed
+    assert stored_mark(db) == high_water_mark(product[23])
@@ -0,0 +1,116 @@
+import importlib.util
+import json
+import sys
+
+import pytest
+from scrapy import Request
+from scrapy.http import TextResponse
+from scrapy.utils.test import get_crawler
+
+from ..spiders.productSpider import ProductSpider
+from ..utils import payloads as payloads_module
+
+
+@pytest.fixture(params=['msgspec', 'json'])
+def payloads(request, monkeypatch):
+    """
+    utils/payloads.py loaded with msgspec and with the stdlib fallback
+    """
+    if request.param == 'msgspec':
+        pytest.importorskip('msgspec')
+    else:
+        monkeypatch.setitem(sys.modules, 'msgspec', None)
+    name = f'payloads_{request.param}'
+    spec = importlib.util.spec_from_file_location(name, payloads_module.__file__)
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, name, module)
+    spec.loader.exec_module(module)
+    return module
+
+
+def listing(**rating):
+    return json.dumps({'result': {
+        'items': [{
+            'productId': 'E470077-000',
+            'name': 'Shirt',
+            'prices': {'base': {'value': 2990, 'currency': {'code': 'JPY'}}, 'promo': None},
+            'colors': [{'name': 'BLACK', 'code': '09'}],
+            'rating': {'average': 4.5, 'count': 12, **rating},
+            'images': {'main': {'09': {'image': 'https://example.com/09.jpg'}}},
+            'unknownField': [1, 2, 3],
+        }],
+        'pagination': {'offset': 0, 'total': 1, 'count': 1},
+    }}).encode('utf-8')
+
+
+def test_listing(payloads):
+    page = payloads.decode_listing(listing())
+
+    [product] = page.items
+    assert product.product_id == 'E470077-000'
+    assert product.prices.base.value == 2990
+    assert product.prices.promo is None
+    assert [color.name for color in product.colors] == ['BLACK']
+    assert (product.rating.average, product.rating.count) == (4.5, 12)
+    assert product.images.main['09'].image == 'https://example.com/09.jpg'
+    assert (page.pagination.offset, page.pagination.total, page.pagination.limit) == (0, 1, None)
+
+
+@pytest.mark.parametrize('rating, expected', [
+    ({'average': '4.5'}, (4.5, 12)),
+    ({'count': '12'}, (4.5, 12)),
+    ({'count': 12.0}, (4.5, 12)),
+    ({'average': 4}, (4, 12)),
+    ({'average': None, 'count': None}, (None, None)),
+])
+def test_numbers_are_decoded_laxly(payloads, rating, expected):
+    [product] = payloads.decode_listing(listing(**rating)).items
+
+    assert (product.rating.average, product.rating.count) == expected
+    assert [type(value) for value in (product.rating.average, product.rating.count)] == \
+        [type(value) for value in expected]
+
+
+@pytest.mark.parametrize('body', [
+    listing(average='great'),
+    listing(count=4.5),
+    listing(average=True),
+    b'{"result": {"items": {"productId": "E1"}}}',
+    b'{"result": {"items": [',
+    b'<html>Service Unavailable</html>',
+])
+def test_both_decoders_reject_the_same_bodies(payloads, body):
+    with pytest.raises(payloads.DECODE_ERRORS):
+        payloads.decode_listing(body)
+
+
+def test_missing_result_and_pagination(payloads):
+    assert payloads.decode_listing(b'{}').items == []
+    page = payloads.decode_reviews(b'{"result": {"reviews": []}}')
+    assert page.reviews == []
+    assert page.pagination.offset == 0
+
+
+def test_reviews(payloads):
+    body = json.dumps({'result': {
+        'reviews': [{'reviewId': 1001, 'createDate': '2024-05-01T10:00:00.000Z', 'title': 'Nice', 'comment': 'Fits',
+                     'purchasedSize': {'name': 'M'}, 'rate': 5}],
+        'pagination': {'offset': 10, 'total': '57', 'limit': 5},
+    }}).encode('utf-8')
+
+    page = payloads.decode_reviews(body)
+
+    [review] = page.reviews
+    assert (review.review_id, review.title, review.purchased_size) == (1001, 'Nice', {'name': 'M'})
+    assert (page.pagination.offset, page.pagination.total, page.pagination.limit) == (10, 57, 5)
+
+
+def test_a_listing_page_that_does_not_decode_is_retried():
+    spider = ProductSpider.from_crawler(get_crawler(ProductSpider, {'RETRY_TIMES': 1}))
+    request = Request('https://www.uniqlo.com/products?offset=72', meta={'path': ',,1641', 'category_id': '1641'})
+
+    [retry] = spider.parse(TextResponse(request.url, body=b'{"result": {', request=request))
+    assert retry.url == request.url
+    assert retry.meta['retry_times'] == 1
+    # out of retries
+    assert list(spider.parse(TextResponse(retry.url, body=b'{"result": {', request=retry))) == []
@@ -0,0 +1,141 @@
+import pymongo.errors
+import pytest
+
+from ..items import ProductItem, item_to_document
+from ..pipelines.product_pipeline import ProductPipeline
+from ..utils.utils import Utils
+from .conftest import MONGO_DB
+
+DAY = 86400
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    The epoch seconds Utils.get_datetime returns, moved forward by the tests
+    """
+    now = [1714521600]
+    monkeypatch.setattr(Utils, 'get_datetime', staticmethod(lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def make_pipeline(mongo_client, clock):
+    def make(bulk_write=True):
+        pipeline = ProductPipeline('mongodb://localhost:27017', MONGO_DB, bulk_write=bulk_write, flush_interval=0)
+        pipeline.open_spider(None)
+        # flushed by the tests, without the timer
+        pipeline.flush_interval = 3600
+        return pipeline
+    return make
+
+
+def product(product_id='P1', price=2990, **fields):
+    listed = dict(item_name='Shirt', color_names=['BLACK'], rating=4.5, review_count=12, product_image='image.jpg',
+                  url='reviews')
+    listed.update(fields)
+    return ProductItem(product_id=product_id, prices=price, **listed)
+
+
+def crawl(pipeline, *items):
+    for item in items:
+        pipeline.process_item(item, None)
+    pipeline.flush()
+
+
+def prices(db, product_id='P1'):
+    return [observation['price'] for observation in db.price_history.find({'product_id': product_id}).sort('date')]
+
+
+@pytest.mark.parametrize('bulk_write', [True, False])
+def test_new_product_records_its_price(make_pipeline, db, clock, bulk_write):
+    crawl(make_pipeline(bulk_write), product())
+
+    stored = db.products.find_one({'product_id': 'P1'})
+    assert (stored['price'], stored['price_date'], stored['item_name']) == (2990, clock[0], 'Shirt')
+    assert prices(db) == [2990]
+
+
+@pytest.mark.parametrize('bulk_write', [True, False])
+def test_price_change_is_recorded_once_a_day(make_pipeline, db, clock, bulk_write):
+    crawl(make_pipeline(bulk_write), product())
+    clock[0] += DAY - 1
+    crawl(make_pipeline(bulk_write), product(price=1990))
+    assert prices(db) == [2990]
+
+    clock[0] += 1
+    crawl(make_pipeline(bulk_write), product(price=1990))
+
+    assert prices(db) == [2990, 1990]
+    assert db.products.find_one({'product_id': 'P1'})['price'] == 1990
+
+
+def test_unchanged_product_is_not_written(make_pipeline, db, clock):
+    crawl(make_pipeline(), product())
+    clock[0] += 2 * DAY
+    pipeline = make_pipeline()
+
+    crawl(pipeline, product())
+
+    assert pipeline.unchanged_count == 1
+    assert prices(db) == [2990]
+
+
+def test_snapshot_matches_the_stored_products(make_pipeline, db, clock):
+    crawl(make_pipeline(), product(), product('P2', price=990))
+    clock[0] += DAY
+
+    pipeline = make_pipeline()
+
+    assert pipeline.snapshot['P1'][:2] == (2990, clock[0] - DAY)
+    assert pipeline.snapshot == make_pipeline().snapshot
+    assert pipeline.build_update(item_to_document(product('P2', price=990))) == (None, None)
+
+
+
+def test_failed_write_keeps_the_snapshot_and_skips_the_price(make_pipeline, db, monkeypatch):
+    pipeline = make_pipeline()
+    bulk_write = pipeline.collection.bulk_write
+    failing = [True]
+
+    def fail_first(operations, ordered=True):
+        if not failing[0]:
+            return bulk_write(operations, ordered=ordered)
+        bulk_write(operations[1:], ordered=ordered)
+        raise pymongo.errors.BulkWriteError({'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'invalid'}]})
+    monkeypatch.setattr(pipeline.collection, 'bulk_write', fail_first)
+
+    crawl(pipeline, product(), product('P2', price=990))
+
+    assert 'P1' not in pipeline.snapshot
+    assert pipeline.snapshot['P2'][0] == 990
+    assert prices(db, 'P1') == []
+    assert prices(db, 'P2') == [990]
+    # the next listing of P1 writes it again
+    failing[0] = False
+    crawl(pipeline, product())
+    assert prices(db, 'P1') == [2990]
+
+
+def test_fields_no_longer_listed_are_unset(make_pipeline, db):
+    crawl(make_pipeline(), product())
+    pipeline = make_pipeline()
+
+    crawl(pipeline, product(rating=None, product_image=None))
+
+    stored = db.products.find_one({'product_id': 'P1'})
+    assert 'rating' not in stored and 'product_image' not in stored
+    assert stored['review_count'] == 12
+    assert pipeline.build_update(item_to_document(product(rating=None, product_image=None))) == (None, None)
+    assert make_pipeline().build_update(item_to_document(product(rating=None, product_image=None))) == (None, None)
+
+
+def test_product_listed_twice_in_a_batch(make_pipeline, db):
+    pipeline = make_pipeline()
+
+    crawl(pipeline, product(), product(review_count=13), product(review_count=13))
+
+    assert prices(db) == [2990]
+    assert db.products.count_documents({}) == 1
+    assert db.products.find_one({'product_id': 'P1'})['review_count'] == 13
+    assert pipeline.unchanged_count == 1
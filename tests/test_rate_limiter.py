@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from ..utils import rate_limiter
+from ..utils.rate_limiter import RateLimiter
+
+shared_file = pytest.mark.skipif(rate_limiter.fcntl is None, reason='the state file needs fcntl')
+
+
+@shared_file
+def test_limiters_sharing_a_state_file_share_the_quota(tmp_path):
+    path = str(tmp_path / 'openai.json')
+    first = RateLimiter(requests_per_minute=2, tokens_per_minute=1000, state_path=path)
+    second = RateLimiter(requests_per_minute=2, tokens_per_minute=1000, state_path=path)
+
+    assert first.try_acquire(100) == 0
+    assert second.try_acquire(100) == 0
+    # both requests came out of the same bucket, the next one has to wait for the refill
+    assert first.try_acquire(100) > 0
+    state = json.loads((tmp_path / 'openai.json').read_text())
+    assert state['requests'] < 1
+    assert state['tokens'] == pytest.approx(800, abs=5)
+
+
+@shared_file
+def test_block_for_reaches_every_process(tmp_path):
+    path = str(tmp_path / 'openai.json')
+    RateLimiter(state_path=path).block_for(30)
+
+    assert RateLimiter(state_path=path).try_acquire() == pytest.approx(30, abs=1)
+
+
+@shared_file
+def test_a_corrupt_state_file_starts_a_full_bucket(tmp_path):
+    path = tmp_path / 'openai.json'
+    path.write_text('{not json')
+
+    assert RateLimiter(state_path=str(path)).try_acquire(10) == 0
+    assert json.loads(path.read_text())['requests'] == pytest.approx(59, abs=0.1)
+
+
+def test_token_budget_limits_requests():
+    limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=600)
+
+    assert limiter.try_acquire(500) == 0
+    # 400 more tokens are missing, refilled at 10 tokens per second
+    assert limiter.try_acquire(500) == pytest.approx(40, abs=0.5)
+
+
+def test_a_request_larger_than_the_bucket_passes_on_a_full_bucket():
+    limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=600)
+
+    assert limiter.try_acquire(10000) == 0
+
+
+def test_exhausted_quota_headers_block_until_the_reset():
+    limiter = RateLimiter()
+    limiter.update_from_headers({'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '6m0s'})
+
+    assert limiter.try_acquire() == pytest.approx(360, abs=1)
+
+
+def test_retry_after_ms_takes_precedence():
+    assert RateLimiter.retry_after({'retry-after-ms': '1500', 'retry-after': '20'}) == 1.5
+    assert RateLimiter.retry_after({'retry-after': '20'}) == 20
+    assert RateLimiter.retry_after({}) is None
+
+
+@pytest.mark.parametrize('value, seconds', [('1s', 1), ('6m0s', 360), ('20ms', 0.02), ('1h2m', 3720), ('', None),
+                                            ('soon', None)])
+def test_parse_duration(value, seconds):
+    assert RateLimiter.parse_duration(value) == (pytest.approx(seconds) if seconds is not None else None)
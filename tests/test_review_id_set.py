@@ -0,0 +1,108 @@
+import pytest
+from scrapy.exceptions import DropItem
+
+from ..pipelines.review_pipeline import ReviewPipeline
+from ..utils.review_id_set import INT64_MAX, INT64_MIN, ReviewIdSet
+from .conftest import crawl_reviews, high_water_mark, make_reviews
+
+
+class Cursor(list):
+    """
+    find() result of a collection returning its documents in the given order
+    """
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def batch_size(self, size):
+        return self
+
+
+class Collection:
+    def __init__(self, review_ids):
+        self.review_ids = review_ids
+
+    def find(self, *args, **kwargs):
+        return Cursor({'review_id': review_id} for review_id in self.review_ids)
+
+
+def test_from_collection(db):
+    db.reviews.insert_many([{'review_id': review_id} for review_id in (5, 1, 3, 'R7', None)])
+
+    review_ids = ReviewIdSet.from_collection(db.reviews)
+
+    assert list(review_ids.ids) == [1, 3, 5]
+    assert review_ids.others == {'R7'}
+    assert len(review_ids) == 4
+    assert review_ids.memory_size() == 24
+
+
+def test_ids_read_out_of_order_are_sorted():
+    review_ids = ReviewIdSet.from_collection(Collection([2, 9, 4, 4.5, 1]))
+
+    assert list(review_ids.ids) == [1, 2, 4, 9]
+    assert all(review_id in review_ids for review_id in (1, 2, 4, 9, 4.5))
+    assert 3 not in review_ids
+
+
+def test_membership_and_add():
+    review_ids = ReviewIdSet([10, 20, 30], ['R1'])
+
+    assert [review_id in review_ids for review_id in (10, 20, 30, 'R1')] == [True] * 4
+    assert [review_id in review_ids for review_id in (0, 15, 31, '10', 'R2', None)] == [False] * 6
+
+    review_ids.add(15)
+    review_ids.add('R2')
+
+    assert 15 in review_ids and 'R2' in review_ids
+    assert len(review_ids) == 6
+
+
+@pytest.mark.parametrize('value, expected', [
+    (0, True),
+    (INT64_MIN, True),
+    (INT64_MAX, True),
+    (INT64_MIN - 1, False),
+    (INT64_MAX + 1, False),
+    (True, False),
+    (1.0, False),
+    ('1', False),
+    (None, False),
+])
+def test_is_int64(value, expected):
+    assert ReviewIdSet.is_int64(value) is expected
+
+
+def test_ids_beyond_int64_are_kept_apart():
+    review_ids = ReviewIdSet.from_collection(Collection([1, INT64_MAX + 1]))
+
+    assert list(review_ids.ids) == [1]
+    assert INT64_MAX + 1 in review_ids
+    assert INT64_MAX not in review_ids
+
+
+def test_pipeline_drops_stored_reviews_and_confirms_them(make_review_spider, mongo_client, db):
+    reviews = make_reviews(10)
+    db.reviews.insert_many([{'product_id': 'P1', 'review_id': review['reviewId'], 'scraped_time': 0}
+                           for review in reviews[6:]])
+    db.products.insert_one({'product_id': 'P1'})
+    spider = make_review_spider()
+    spider.review_page_size = 5
+    spider.crawl_plan = [{'product_id': 'P1', 'new_reviews': 10}]
+    items, _ = crawl_reviews(spider, {'P1': reviews})
+    pipeline = ReviewPipeline(flush_interval=0, preload_review_ids=True, translate=False)
+    pipeline.open_spider(None)
+    pipeline.flush_interval = 3600
+
+    dropped = []
+    for item in items:
+        try:
+            pipeline.process_item(item, spider)
+        except DropItem:
+            dropped.append(item.review_id)
+    pipeline.flush(spider)
+    spider.closed('finished')
+
+    assert dropped == [review['reviewId'] for review in reviews[6:]]
+    assert db.reviews.count_documents({}) == 10
+    assert db.products.find_one({'product_id': 'P1'})['review_high_water_mark'] == high_water_mark(reviews[0])
@@ -0,0 +1,138 @@
+from scrapy import Request
+
+from ..utils.payloads import decode_reviews
+from .conftest import crawl_reviews, high_water_mark, make_reviews, review_response
+
+
+def start(spider, new_reviews, page_size=5):
+    spider.review_page_size = page_size
+    spider.crawl_plan = [{'product_id': 'P1', 'new_reviews': new_reviews}]
+    return spider
+
+
+def parse(spider, request, reviews, max_page_size=None):
+    """
+    :return: tuple of (items, requests) the spider yields for the page
+    """
+    outputs = list(spider.parse_review(review_response(request, reviews, max_page_size)))
+    return ([output for output in outputs if not isinstance(output, Request)],
+            [output for output in outputs if isinstance(output, Request)])
+
+
+def test_every_page_of_a_new_product_is_crawled(make_review_spider):
+    reviews = make_reviews(12)
+    spider = start(make_review_spider(), len(reviews))
+
+    items, requested = crawl_reviews(spider, {'P1': reviews})
+
+    assert [item.review_id for item in items] == [review['reviewId'] for review in reviews]
+    assert requested['P1'] == [(0, 5), (5, 5), (10, 5)]
+    assert 'P1' in spider.products_done
+
+
+def test_pages_after_the_first_are_requested_in_parallel(make_review_spider):
+    reviews = make_reviews(50)
+    spider = start(make_review_spider({'REVIEW_PAGES_IN_FLIGHT': 3}), len(reviews))
+    [first] = spider.product_start_requests()
+
+    _, requests = parse(spider, first, reviews)
+
+    assert [request.meta['offset'] for request in requests] == [5, 10, 15]
+    assert spider.product_pages['P1']['pending'] == {5, 10, 15}
+    # a parsed page makes room for the next one
+    _, more = parse(spider, requests[0], reviews)
+    assert [request.meta['offset'] for request in more] == [20]
+
+
+def test_pages_past_the_stop_offset_are_skipped(make_review_spider, db):
+    reviews = make_reviews(30)
+    db.products.insert_one({'product_id': 'P1', 'review_high_water_mark': high_water_mark(reviews[12])})
+    spider = start(make_review_spider({'REVIEW_PAGES_IN_FLIGHT': 8}), len(reviews))
+    [first] = spider.product_start_requests()
+    _, requests = parse(spider, first, reviews)
+    by_offset = {request.meta['offset']: request for request in requests}
+
+    # the page holding the mark arrives before the page in front of it
+    items, _ = parse(spider, by_offset[10], reviews)
+
+    assert [item.review_id for item in items] == [reviews[10]['reviewId'], reviews[11]['reviewId']]
+    assert spider.product_pages['P1']['stop_offset'] == 15
+    assert [offset for offset in by_offset if spider.skip_page('P1', offset)] == [15, 20, 25]
+    # still waiting for the page at offset 5
+    assert 'P1' not in spider.products_done
+    parse(spider, by_offset[5], reviews)
+    assert 'P1' in spider.products_done
+
+
+def test_a_failed_page_leaves_the_product_unfinished(make_review_spider):
+    reviews = make_reviews(12)
+    spider = start(make_review_spider(), len(reviews))
+    [first] = spider.product_start_requests()
+    _, requests = parse(spider, first, reviews)
+
+    # the page at offset 5 never comes back
+    parse(spider, requests[1], reviews)
+
+    assert spider.product_pages['P1']['pending'] == {5}
+    assert 'P1' not in spider.products_done
+
+
+def test_a_capped_page_size_crawls_every_review_once(make_review_spider):
+    reviews = make_reviews(23)
+    spider = start(make_review_spider(), len(reviews), page_size=10)
+
+    # the endpoint echoes limit=10 but serves 4 reviews per page
+    items, requested = crawl_reviews(spider, {'P1': reviews}, max_page_size=4)
+
+    assert [item.review_id for item in items] == [review['reviewId'] for review in reviews]
+    assert requested['P1'][:3] == [(0, 10), (4, 4), (8, 4)]
+    assert spider.review_page_size == 4
+    assert 'P1' in spider.products_done
+
+
+def test_a_short_page_after_the_first_is_completed_by_a_gap_page(make_review_spider):
+    reviews = make_reviews(20)
+    spider = start(make_review_spider(), len(reviews))
+    [first] = spider.product_start_requests()
+    _, requests = parse(spider, first, reviews)
+    assert [request.meta['offset'] for request in requests] == [5, 10, 15]
+
+    items, gap = parse(spider, requests[0], reviews, max_page_size=3)
+    for request in requests[1:]:
+        more, _ = parse(spider, request, reviews)
+        items += more
+    assert [(request.meta['offset'], request.meta['limit']) for request in gap] == [(8, 2)]
+    assert 'P1' not in spider.products_done
+    more, _ = parse(spider, gap[0], reviews)
+    items += more
+
+    assert sorted(item.review_id for item in items) == sorted(review['reviewId'] for review in reviews[5:])
+    assert 'P1' in spider.products_done
+
+
+def test_the_last_page_may_be_short(make_review_spider):
+    reviews = make_reviews(7)
+    spider = start(make_review_spider(), len(reviews))
+
+    _, requested = crawl_reviews(spider, {'P1': reviews})
+
+    assert requested['P1'] == [(0, 5), (5, 5)]
+    assert spider.review_page_size == 5
+
+
+def test_served_page_size(make_review_spider):
+    spider = make_review_spider()
+    request = Request('https://www.uniqlo.com/reviews', meta={'product_id': 'P1', 'offset': 0, 'limit': 100})
+    reviews = make_reviews(200)
+
+    def page_size(max_page_size=None, total=200, echoed_limit=100):
+        page = decode_reviews(review_response(request, reviews[:total], max_page_size).body)
+        page.pagination.limit = echoed_limit
+        return spider.served_page_size(page, 100)
+
+    # the probe: a short page with more reviews left means the limit was capped, whatever is echoed
+    assert page_size(max_page_size=30) == 30
+    assert page_size(max_page_size=30, echoed_limit=None) == 30
+    assert page_size(echoed_limit=50) == 50
+    # every review of the product fit on the page
+    assert page_size(total=30) == 100
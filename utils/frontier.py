@@ -0,0 +1,130 @@
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+
+import pymongo.errors
+from pymongo import ReturnDocument, UpdateOne
+
+
+class ReviewFrontier:
+    """
+    Mongo-backed work queue of products whose reviews need crawling, shared by several reviewSpider
+    processes. Workers claim products with a lease, renew it while they crawl and mark the products
+    done; the products of a crashed worker are claimed again once its leases expire.
+
+    Frontier documents: {_id: product_id, new_reviews, state: pending|leased|done|failed,
+    lease_owner, lease_expires, attempts}
+    """
+
+    def __init__(self, collection, worker_id=None, lease_seconds=300, max_attempts=3):
+        self.collection = collection
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    @staticmethod
+    def now():
+        return datetime.now(timezone.utc)
+
+    def seed(self, crawl_plan):
+        """
+        Queue the products of a crawl plan. Products already pending or leased by a worker are left
+        alone, finished ones are queued again; several workers may seed the same plan concurrently.
+        :param crawl_plan: list of dicts with product_id and new_reviews, see fetch_review_crawl_plan
+        :return: number of products queued
+        """
+        if not crawl_plan:
+            return 0
+        self.fail_exhausted()
+        operations = [
+            UpdateOne(
+                {'_id': plan['product_id'], 'state': {'$in': ['done', 'failed']}},
+                {'$set': {'state': 'pending', 'new_reviews': plan['new_reviews'], 'attempts': 0}},
+                upsert=True,
+            )
+            for plan in crawl_plan
+        ]
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+            return result.upserted_count + result.modified_count
+        except pymongo.errors.BulkWriteError as e:
+            # the upsert of a product that is pending or leased hits its _id, which is what we want
+            write_errors = e.details.get('writeErrors', [])
+            for error in write_errors:
+                if error.get('code') != 11000:
+                    logging.error(f"Failed to queue product for review crawling: {error.get('errmsg')}")
+            return e.details.get('nUpserted', 0) + e.details.get('nModified', 0)
+
+    def claim(self, count):
+        """
+        Atomically lease up to count products, those with the most new reviews first
+        :param count: the number of products to claim
+        :return: list of dicts with product_id and new_reviews
+        """
+        self.fail_exhausted()
+        claimed = []
+        while len(claimed) < count:
+            now = self.now()
+            document = self.collection.find_one_and_update(
+                {
+                    '$or': [{'state': 'pending'}, {'state': 'leased', 'lease_expires': {'$lt': now}}],
+                    'attempts': {'$lt': self.max_attempts},
+                },
+                {
+                    '$set': {'state': 'leased', 'lease_owner': self.worker_id,
+                             'lease_expires': now + timedelta(seconds=self.lease_seconds)},
+                    '$inc': {'attempts': 1},
+                },
+                sort=[('new_reviews', pymongo.DESCENDING)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if document is None:
+                break
+            claimed.append({'product_id': document['_id'], 'new_reviews': document.get('new_reviews', 0)})
+        return claimed
+
+    def fail_exhausted(self):
+        """
+        Mark failed the products whose lease expired on their last attempt; claim skips them, so they
+        would stay leased and keep the queue from draining
+        :return: number of products marked failed
+        """
+        result = self.collection.update_many(
+            {'state': 'leased', 'lease_expires': {'$lt': self.now()}, 'attempts': {'$gte': self.max_attempts}},
+            {'$set': {'state': 'failed'}, '$unset': {'lease_owner': '', 'lease_expires': ''}},
+        )
+        if result.modified_count:
+            logging.warning(f"Gave up on {result.modified_count} products after {self.max_attempts} attempts")
+        return result.modified_count
+
+    def renew(self, product_ids):
+        """
+        Extend the leases this worker holds on the given products
+        :param product_ids: ids of the products still being crawled
+        """
+        if not product_ids:
+            return
+        self.collection.update_many(
+            {'_id': {'$in': list(product_ids)}, 'state': 'leased', 'lease_owner': self.worker_id},
+            {'$set': {'lease_expires': self.now() + timedelta(seconds=self.lease_seconds)}},
+        )
+
+    def complete(self, product_id):
+        self.collection.update_one(
+            {'_id': product_id, 'lease_owner': self.worker_id},
+            {'$set': {'state': 'done', 'done_at': self.now()}, '$unset': {'lease_owner': '', 'lease_expires': ''}},
+        )
+
+    def release(self, product_ids):
+        """
+        Hand back products this worker claimed but couldn't finish, so another worker can retry them;
+        products that used up their attempts are marked failed
+        :param product_ids: ids of the unfinished products
+        """
+        if not product_ids:
+            return
+        query = {'_id': {'$in': list(product_ids)}, 'state': 'leased', 'lease_owner': self.worker_id}
+        unset = {'$unset': {'lease_owner': '', 'lease_expires': ''}}
+        self.collection.update_many({**query, 'attempts': {'$gte': self.max_attempts}}, {'$set': {'state': 'failed'}, **unset})
+        self.collection.update_many(query, {'$set': {'state': 'pending'}, **unset})
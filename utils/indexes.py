@@ -0,0 +1,111 @@
+import argparse
+import logging
+import os
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
+
+from .price_history import PRICE_HISTORY_COLLECTION, ensure_price_history
+
+# every index the crawler relies on, created idempotently at startup
+INDEXES = {
+    'products': [
+        IndexModel([('product_id', ASCENDING)], unique=True, name='product_id_unique'),
+    ],
+    'reviews': [
+        IndexModel([('review_id', DESCENDING)], unique=True),
+        IndexModel([('product_id', ASCENDING), ('created_date', DESCENDING)], name='product_id_created_date'),
+        IndexModel([('scraped_time', DESCENDING)], name='scraped_time'),
+        IndexModel([('translated', ASCENDING), ('translation_lease_expires', ASCENDING)], name='translated_lease'),
+    ],
+    'review_frontier': [
+        IndexModel([('state', ASCENDING), ('new_reviews', DESCENDING)], name='state_new_reviews'),
+    ],
+}
+
+# the hot queries of utils/utils.py and the pipelines, as (description, collection, filter, sort)
+HOT_QUERIES = [
+    ('fetch_product_with_review_counts', 'products', {'product_id': ''}, None),
+    ('fetch_latest_scraped_time', 'reviews', {}, [('scraped_time', DESCENDING)]),
+    ('count_reviews_in_db / fetch_review_crawl_plan $lookup', 'reviews', {'product_id': ''}, None),
+    ('ReviewIdSet.from_collection', 'reviews', {}, [('review_id', ASCENDING)]),
+    ('TranslationBackfill.claim', 'reviews', {'translated': {'$ne': True}}, None),
+    ('fetch_price_history', PRICE_HISTORY_COLLECTION, {'product_id': ''}, [('date', DESCENDING)]),
+]
+
+
+def ensure_indexes(db):
+    """
+    Create the declared indexes, existing ones are left as they are
+    :param db: the pymongo database
+    """
+    ensure_price_history(db)
+    for collection_name, indexes in INDEXES.items():
+        names = db[collection_name].create_indexes(indexes)
+        logging.info(f"Indexes on {collection_name}: {', '.join(names)}")
+
+
+# plans the optimizer considered and didn't run
+REJECTED_PLAN_KEYS = ('rejectedPlans', 'allPlansExecution')
+
+
+def find_stages(plan, stage):
+    """
+    Walk an explain plan (or a whole explain output) and return every sub-plan of the given stage
+    that is part of the winning plan
+    """
+    found = []
+    if isinstance(plan, dict):
+        if plan.get('stage') == stage:
+            found.append(plan)
+        for key, value in plan.items():
+            if key not in REJECTED_PLAN_KEYS:
+                found.extend(find_stages(value, stage))
+    elif isinstance(plan, list):
+        for value in plan:
+            found.extend(find_stages(value, stage))
+    return found
+
+
+def check_query_plans(db):
+    """
+    Explain each hot query and fail on any collection scan
+    :param db: the pymongo database
+    :raises RuntimeError: listing the queries that don't use an index
+    """
+    failures = []
+    for description, collection_name, query_filter, sort in HOT_QUERIES:
+        cursor = db[collection_name].find(query_filter).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        # the whole explain output: time-series collections nest the plan under stages[0]['$cursor']
+        if find_stages(cursor.explain(), 'COLLSCAN'):
+            failures.append(f"{description}: COLLSCAN on {collection_name} for {query_filter or sort}")
+        else:
+            logging.info(f"{description}: uses an index")
+    if failures:
+        raise RuntimeError('Queries without an index:\n' + '\n'.join(failures))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create the MongoDB indexes used by the crawler')
+    parser.add_argument('--check', action='store_true', help='explain the hot queries and fail on any COLLSCAN')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    mongo_url = os.getenv('MONGO_URL')
+    if not mongo_url:
+        raise EnvironmentError('MONGO_URL is not set')
+    client = MongoClient(mongo_url)
+    try:
+        db = client[os.getenv('MONGO_DB', 'uniqlo')]
+        ensure_indexes(db)
+        if args.check:
+            check_query_plans(db)
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import bisect
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+# upper bounds in seconds, Prometheus style
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   float('inf'))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        Estimate a percentile as the upper bound of the bucket it falls in (the max for the last bucket)
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'avg': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class StageMetrics:
+    """
+    Latency histograms per crawl stage and gauges for queue depths, shared by the spiders, the
+    pipelines and the translation client of one crawler; StageMetricsExtension reports them
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        # name -> callable returning the current value, sampled by the extension
+        self.gauges = {}
+        self.gauge_values = {}
+        self.gauge_max = {}
+        # translations and Mongo writes are timed from the reactor thread pool as well
+        self.lock = Lock()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # one collector per crawler
+        if getattr(crawler, 'stage_metrics', None) is None:
+            crawler.stage_metrics = cls()
+        return crawler.stage_metrics
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Time the block as one observation of the stage, also when it raises
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def register_gauge(self, name, read):
+        self.gauges[name] = read
+
+    def sample_gauges(self):
+        for name, read in list(self.gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                # e.g. the engine is not running yet or any more
+                continue
+            with self.lock:
+                self.gauge_values[name] = value
+                self.gauge_max[name] = max(self.gauge_max.get(name, value), value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'stages': {stage: histogram.summary() for stage, histogram in sorted(self.histograms.items())},
+                'gauges': {name: {'current': value, 'max': self.gauge_max[name]}
+                           for name, value in sorted(self.gauge_values.items())},
+            }
+
+    def update_stats(self, stats):
+        """
+        Copy the summaries into the Scrapy stats collector
+        """
+        snapshot = self.snapshot()
+        for stage, summary in snapshot['stages'].items():
+            for key, value in summary.items():
+                stats.set_value(f'stage_latency/{stage}/{key}', round(value, 6) if isinstance(value, float) else value)
+        for name, values in snapshot['gauges'].items():
+            stats.set_value(f'queue_depth/{name}/max', values['max'])
+
+    def prometheus_text(self):
+        """
+        Render the histograms and gauges in the Prometheus text exposition format
+        """
+        lines = ['# HELP uniqlo_stage_latency_seconds Latency of each crawl stage',
+                 '# TYPE uniqlo_stage_latency_seconds histogram']
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'uniqlo_stage_latency_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'uniqlo_stage_latency_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'uniqlo_stage_latency_seconds_count{{stage="{stage}"}} {histogram.count}')
+            lines += ['# HELP uniqlo_queue_depth Items or requests waiting in each queue',
+                      '# TYPE uniqlo_queue_depth gauge']
+            for name, value in sorted(self.gauge_values.items()):
+                lines.append(f'uniqlo_queue_depth{{queue="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
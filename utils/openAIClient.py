@@ -1,36 +1,52 @@
+import json
+import logging
 import time
 from openai import OpenAI, OpenAIError
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from .rate_limiter import RateLimiter
+from .metrics import StageMetrics
+
+BATCH_TRANSLATION_PROMPT = (
+    "You translate Japanese product reviews into English. "
+    "The user sends a JSON object with a \"reviews\" array; each review has a review_id, a title and a comment. "
+    "Reply with a JSON object with a \"translations\" array holding one object per review, "
+    "with the same review_id and the translated title and comment. "
+    "Do not merge, split or skip reviews."
+)
+
 
 class OpenAiApiClient:
-    def __init__(self, api_key, assistant_id):
+    def __init__(self, api_key, assistant_id, model='gpt-3.5-turbo-1106', max_batch_tokens=3000, cache=None,
+                 rate_limiter=None, metrics=None):
         self.api_key = api_key
         self.assistant_id = assistant_id
+        self.model = model
+        self.max_batch_tokens = max_batch_tokens
+        # optional TranslationCache, consulted before any request is sent
+        self.cache = cache
         self.client = OpenAI(
             api_key=self.api_key,
         )
-        self.last_request_time = time.time()
-        self.lock = Lock()
-        self.request_count = 0
-
-    def handle_rate_limit(self):
-        current_time = int(time.time())
-        # Reset the request count if it has been 60 seconds since the last request
-        if current_time - self.last_request_time >= 60:
-            self.request_count = 0
-            self.last_request_time = current_time
-        # If the request count is greater than or equal to 60, wait until the next minute
-        if self.request_count >= 60:
-            time.sleep(60 - (current_time - self.last_request_time))
-        # Increment the request count for every request
-        self.request_count += 1
+        # shared RPM/TPM limiter; pass the same instance (or state file) to every client using the key
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # times the rate limiter waits and every batch request, retries separately from first attempts
+        self.metrics = metrics or StageMetrics()
+
+    def handle_rate_limit(self, tokens=0):
+        # waits outside any lock, so other threads keep going while one is throttled
+        with self.metrics.time('translation/rate_limit_wait'):
+            self.rate_limiter.acquire(tokens)
 
     def handle_error(self, e):
-        if e.__getattribute__('status_code') == 429:
-            print('Too many requests, waiting for reset')
+        response = getattr(e, 'response', None)
+        headers = response.headers if response is not None else None
+        if getattr(e, 'status_code', None) == 429:
+            retry_after = RateLimiter.retry_after(headers) if headers is not None else None
+            logging.warning(f'Too many requests, waiting {retry_after or 10}s for reset')
+            self.rate_limiter.block_for(retry_after or 10)
         else:
-            print(f'An error occurred: {e}')
+            self.rate_limiter.update_from_headers(headers)
+            logging.error(f'An error occurred: {e}')
 
     def create_thread(self):
         return self.client.beta.threads.create()
@@ -63,13 +79,19 @@ class OpenAiApiClient:
                 return message.content[0].text.value
 
     def translate_japanese(self, text, max_retry=3):
+        if self.cache is not None:
+            cached_text = self.cache.get(text)
+            if cached_text:
+                return cached_text
         retry_count = 0
         while retry_count < max_retry:
-            self.handle_rate_limit()
+            self.handle_rate_limit(2 * self.estimate_tokens(text))
             try:
                 thread_id = self.create_and_send_message(text)
                 translated_text = self.wait_for_completion_and_fetch_result(thread_id)
                 if translated_text:
+                    if self.cache is not None:
+                        self.cache.set(text, translated_text)
                     return translated_text
             except OpenAIError as e:
                 self.handle_error(e)
@@ -85,5 +107,126 @@ class OpenAiApiClient:
                 results[idx] = future.result()
         return results
 
-
-
+    @staticmethod
+    def estimate_tokens(text):
+        """
+        Rough token estimate for a piece of text. Japanese text is close to one token per character,
+        so the character count is a safe upper bound.
+        :param text: the text to estimate
+        :return: estimated number of tokens
+        """
+        return len(text or '')
+
+    def estimate_review_tokens(self, review):
+        return self.estimate_tokens(review.get('title')) + self.estimate_tokens(review.get('comment')) + 20
+
+    def split_into_batches(self, reviews):
+        """
+        Split the reviews into batches that each stay within max_batch_tokens
+        :param reviews: list of dicts with review_id, title and comment
+        :return: list of batches
+        """
+        batches = []
+        batch, batch_tokens = [], 0
+        for review in reviews:
+            review_tokens = self.estimate_review_tokens(review)
+            if batch and batch_tokens + review_tokens > self.max_batch_tokens:
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(review)
+            batch_tokens += review_tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def send_translation_batch(self, reviews):
+        payload = {'reviews': [
+            {'review_id': review['review_id'], 'title': review.get('title') or '', 'comment': review.get('comment') or ''}
+            for review in reviews
+        ]}
+        raw_response = self.client.chat.completions.with_raw_response.create(
+            model=self.model,
+            response_format={'type': 'json_object'},
+            messages=[
+                {'role': 'system', 'content': BATCH_TRANSLATION_PROMPT},
+                {'role': 'user', 'content': json.dumps(payload, ensure_ascii=False)},
+            ],
+        )
+        self.rate_limiter.update_from_headers(raw_response.headers)
+        response = raw_response.parse()
+        choice = response.choices[0]
+        # a refusal has no content and a truncated one (finish_reason 'length') isn't valid JSON
+        if choice.finish_reason != 'stop' or choice.message.content is None:
+            raise ValueError(f"Translation response ended with finish_reason={choice.finish_reason!r}")
+        content = json.loads(choice.message.content)
+        return {
+            str(translation.get('review_id')): {'title': translation.get('title'), 'comment': translation.get('comment')}
+            for translation in content.get('translations', [])
+            if isinstance(translation, dict)
+        }
+
+    def translate_reviews_batch(self, reviews, max_retry=3):
+        """
+        Translate several reviews per chat request, each request staying within max_batch_tokens.
+        Titles and comments found in the cache are not sent again.
+        :param reviews: list of dicts with review_id, title and comment
+        :param max_retry: the number of attempts per batch
+        :return: dict of review_id -> {'title': ..., 'comment': ...}; reviews that failed are left out
+        """
+        translations = {}
+        cached = {}
+        if self.cache is not None:
+            cached = self.cache.get_many([text for review in reviews
+                                          for text in (review.get('title'), review.get('comment')) if text])
+
+        to_translate = []
+        for review in reviews:
+            title, comment = review.get('title') or '', review.get('comment') or ''
+            if (not title or title in cached) and (not comment or comment in cached):
+                translations[str(review['review_id'])] = {'title': cached.get(title, ''), 'comment': cached.get(comment, '')}
+            else:
+                # only send the parts that are not cached yet
+                to_translate.append({
+                    'review_id': review['review_id'],
+                    'title': '' if title in cached else title,
+                    'comment': '' if comment in cached else comment,
+                })
+        originals = {str(review['review_id']): review for review in reviews}
+
+        for batch in self.split_into_batches(to_translate):
+            retry_count = 0
+            # the translation comes back at roughly the size of the source text
+            batch_tokens = 2 * sum(self.estimate_review_tokens(review) for review in batch) + \
+                self.estimate_tokens(BATCH_TRANSLATION_PROMPT)
+            while retry_count < max_retry:
+                self.handle_rate_limit(batch_tokens)
+                try:
+                    with self.metrics.time('translation/retry' if retry_count else 'translation/request'):
+                        batch_translations = self.send_translation_batch(batch)
+                    break
+                except OpenAIError as e:
+                    self.handle_error(e)
+                except (ValueError, TypeError, AttributeError, IndexError) as e:
+                    logging.warning(f"Malformed batch translation response: {e}")
+                retry_count += 1
+            else:
+                continue
+
+            new_entries = {}
+            for review_id, translation in batch_translations.items():
+                original = originals.get(review_id)
+                if original is None:
+                    continue
+                title, comment = original.get('title') or '', original.get('comment') or ''
+                translation = {
+                    'title': cached.get(title, translation.get('title') if title else ''),
+                    'comment': cached.get(comment, translation.get('comment') if comment else ''),
+                }
+                translations[review_id] = translation
+                if title not in cached and translation['title']:
+                    new_entries[title] = translation['title']
+                if comment not in cached and translation['comment']:
+                    new_entries[comment] = translation['comment']
+            if self.cache is not None:
+                self.cache.set_many(new_entries)
+        return translations
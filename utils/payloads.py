@@ -0,0 +1,222 @@
+import copy
+import json
+import typing
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import msgspec
+except ImportError:  # falls back to the stdlib json module and a slower conversion into the same types
+    msgspec = None
+
+
+if msgspec is not None:
+    class Payload(msgspec.Struct, rename='camel'):
+        """
+        Base of the API payload types: msgspec decodes and validates the response bytes straight
+        into them, ignoring fields that aren't declared. Decoding is lax (strict=False), so numbers
+        sent as strings are accepted as the fallback accepts them
+        """
+
+    DECODE_ERRORS = (json.JSONDecodeError, msgspec.DecodeError)
+else:
+    class Payload:
+        """
+        Stdlib stand-in for msgspec.Struct: builds the same types from json.loads output
+        """
+
+        def __init__(self, **kwargs):
+            for name in fields(type(self)):
+                setattr(self, name, kwargs[name] if name in kwargs else copy.copy(getattr(type(self), name, None)))
+            if hasattr(self, '__post_init__'):
+                self.__post_init__()
+
+        def __repr__(self):
+            values = ', '.join(f'{name}={getattr(self, name)!r}' for name in fields(type(self)))
+            return f'{type(self).__name__}({values})'
+
+    DECODE_ERRORS = (json.JSONDecodeError, TypeError, ValueError)
+
+    @lru_cache(maxsize=None)
+    def fields(cls):
+        return typing.get_type_hints(cls)
+
+
+class Pagination(Payload):
+    offset: int = 0
+    total: Optional[int] = None
+    count: Optional[int] = None
+    limit: Optional[int] = None
+
+
+class Price(Payload):
+    value: Union[int, float, None] = None
+
+
+class Prices(Payload):
+    base: Optional[Price] = None
+    promo: Optional[Price] = None
+
+
+class Color(Payload):
+    name: Optional[str] = None
+
+
+class Rating(Payload):
+    average: Union[int, float, None] = None
+    count: Optional[int] = None
+
+
+class Image(Payload):
+    image: Optional[str] = None
+
+
+class Images(Payload):
+    main: Dict[str, Image] = {}
+
+
+class Product(Payload):
+    product_id: Optional[str] = None
+    name: Optional[str] = None
+    prices: Optional[Prices] = None
+    colors: List[Color] = []
+    rating: Optional[Rating] = None
+    images: Optional[Images] = None
+
+
+class ListingResult(Payload):
+    items: List[Product] = []
+    pagination: Optional[Pagination] = None
+
+    def __post_init__(self):
+        if self.pagination is None:
+            self.pagination = Pagination()
+
+
+class ListingResponse(Payload):
+    result: Optional[ListingResult] = None
+
+
+class Review(Payload):
+    review_id: Any = None
+    purchased_size: Any = None
+    comment: Optional[str] = None
+    fit: Any = None
+    gender: Any = None
+    location: Any = None
+    name: Optional[str] = None
+    rate: Any = None
+    title: Optional[str] = None
+    create_date: Any = None
+
+
+class ReviewsResult(Payload):
+    reviews: List[Review] = []
+    pagination: Optional[Pagination] = None
+
+    def __post_init__(self):
+        if self.pagination is None:
+            self.pagination = Pagination()
+
+
+class ReviewsResponse(Payload):
+    result: Optional[ReviewsResult] = None
+
+
+def camel_case(name):
+    first, *rest = name.split('_')
+    return first + ''.join(part.title() for part in rest)
+
+
+def convert(value, type_):
+    """
+    Convert json.loads output into the payload types, the fallback for msgspec's decoding
+    """
+    if value is None:
+        return None
+    origin = typing.get_origin(type_)
+    if origin is Union:
+        payload_types = [arg for arg in typing.get_args(type_) if isinstance(arg, type) and issubclass(arg, Payload)]
+        if payload_types:
+            return convert(value, payload_types[0])
+        scalar_types = tuple(arg for arg in typing.get_args(type_) if arg in SCALAR_TYPES)
+        return convert_scalar(value, scalar_types) if scalar_types else value
+    if origin is list:
+        if not isinstance(value, list):
+            raise TypeError(f'Expected an array, got {type(value).__name__}')
+        return [convert(item, typing.get_args(type_)[0]) for item in value]
+    if origin is dict:
+        if not isinstance(value, dict):
+            raise TypeError(f'Expected an object, got {type(value).__name__}')
+        return {key: convert(item, typing.get_args(type_)[1]) for key, item in value.items()}
+    if isinstance(type_, type) and issubclass(type_, Payload):
+        if not isinstance(value, dict):
+            raise TypeError(f'Expected an object for {type_.__name__}, got {type(value).__name__}')
+        return type_(**{
+            name: convert(value[camel_case(name)], field_type)
+            for name, field_type in fields(type_).items() if camel_case(name) in value
+        })
+    if type_ in SCALAR_TYPES:
+        return convert_scalar(value, (type_,))
+    return value
+
+
+SCALAR_TYPES = (int, float, str)
+
+
+def convert_scalar(value, types):
+    """
+    Check a scalar against the field's types the way msgspec's lax mode does: numbers may come as
+    strings, and integral floats are accepted for int fields
+    :param value: the json.loads value
+    :param types: tuple of the accepted types among int, float and str
+    :return: the converted value
+    :raises TypeError: if the value has none of the types
+    :raises ValueError: if a string doesn't hold a number
+    """
+    if isinstance(value, str):
+        if str in types:
+            return value
+        if value != value.strip():
+            raise ValueError(f'Expected a number, got {value!r}')
+        try:
+            value = int(value)
+        except ValueError:
+            value = float(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if int in types and (isinstance(value, int) or (float not in types and value.is_integer())):
+            return int(value)
+        if float in types:
+            return float(value)
+    raise TypeError(f"Expected {' or '.join(t.__name__ for t in types)}, got {type(value).__name__}")
+
+
+def decode(body, type_):
+    """
+    Decode a response body straight from bytes into the given payload type
+    :param body: the response body
+    :param type_: the payload type
+    :return: an instance of type_
+    :raises: one of DECODE_ERRORS if the body is not valid JSON or doesn't match the type
+    """
+    if msgspec is not None:
+        return msgspec.json.decode(body, type=type_, strict=False)
+    return convert(json.loads(body), type_)
+
+
+def decode_listing(body):
+    """
+    Decode a /products listing page
+    :param body: the response body
+    :return: ListingResult
+    """
+    return decode(body, ListingResponse).result or ListingResult()
+
+
+def decode_reviews(body):
+    """
+    Decode a /reviews page
+    :param body: the response body
+    :return: ReviewsResult
+    """
+    return decode(body, ReviewsResponse).result or ReviewsResult()
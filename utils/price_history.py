@@ -0,0 +1,102 @@
+import argparse
+import logging
+import os
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+# price observations live in a time-series collection, the product document only keeps the latest price
+PRICE_HISTORY_COLLECTION = 'price_history'
+PRICE_HISTORY_TIME_SERIES = {'timeField': 'date', 'metaField': 'product_id', 'granularity': 'hours'}
+PRICE_HISTORY_INDEXES = [
+    IndexModel([('product_id', ASCENDING), ('date', DESCENDING)], name='product_id_date'),
+]
+
+
+def ensure_price_history(db):
+    """
+    Create the price_history time-series collection and its index, an existing one is left as it is
+    :param db: the pymongo database
+    """
+    if PRICE_HISTORY_COLLECTION not in db.list_collection_names(filter={'name': PRICE_HISTORY_COLLECTION}):
+        try:
+            db.create_collection(PRICE_HISTORY_COLLECTION, timeseries=PRICE_HISTORY_TIME_SERIES)
+        except CollectionInvalid:
+            pass
+        except OperationFailure as e:
+            # NamespaceExists: another crawler process created it first
+            if e.code != 48:
+                raise
+    db[PRICE_HISTORY_COLLECTION].create_indexes(PRICE_HISTORY_INDEXES)
+
+
+def price_observation(product_id, price, timestamp):
+    """
+    Build a price_history document
+    :param product_id: the product id
+    :param price: the observed price
+    :param timestamp: epoch seconds, as returned by Utils.get_datetime
+    :return: dict
+    """
+    return {
+        'product_id': product_id,
+        'date': datetime.fromtimestamp(timestamp, timezone.utc),
+        'price': price,
+    }
+
+
+def migrate_embedded_prices(db, collection_name='products', batch_size=1000):
+    """
+    Move the embedded prices arrays of older product documents into price_history, keeping the
+    last entry as the product's price and price_date
+    :param db: the pymongo database
+    :param collection_name: the name of the products collection
+    :param batch_size: observations written per insert_many
+    :return: number of migrated products
+    """
+    products = db[collection_name]
+    history = db[PRICE_HISTORY_COLLECTION]
+    migrated = 0
+    observations = []
+    for product in products.find({'prices': {'$exists': True}}, {'product_id': 1, 'prices': 1}):
+        prices = [entry for entry in product.get('prices') or [] if isinstance(entry, dict)]
+        observations.extend(price_observation(product['product_id'], entry.get('price'), entry['date'])
+                            for entry in prices if entry.get('date') is not None)
+        update = {'$unset': {'prices': ''}}
+        if prices:
+            update['$set'] = {'price': prices[-1].get('price'), 'price_date': prices[-1].get('date')}
+        products.update_one({'_id': product['_id']}, update)
+        migrated += 1
+        if len(observations) >= batch_size:
+            history.insert_many(observations, ordered=False)
+            observations = []
+    if observations:
+        history.insert_many(observations, ordered=False)
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the price_history time-series collection')
+    parser.add_argument('--migrate', action='store_true',
+                        help='move the embedded prices arrays of the products into price_history')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    mongo_url = os.getenv('MONGO_URL')
+    if not mongo_url:
+        raise EnvironmentError('MONGO_URL is not set')
+    client = MongoClient(mongo_url)
+    try:
+        db = client[os.getenv('MONGO_DB', 'uniqlo')]
+        ensure_price_history(db)
+        if args.migrate:
+            logging.info(f'Migrated the price history of {migrate_embedded_prices(db)} products')
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import cProfile
+import functools
+import os
+import pstats
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+class StageProfiler:
+    """
+    cProfile profiles per crawl stage (spider callbacks, pipeline process_item), shared by the
+    spider middleware and the pipelines of one crawler; ProfilingExtension writes them out.
+    Only every Nth call of a stage is profiled, so it can stay on in production.
+    """
+
+    def __init__(self, enabled=False, every=1):
+        self.enabled = enabled
+        self.every = max(1, every)
+        self.profiles = {}
+        self.calls = Counter()
+        self.sampled = Counter()
+        # cProfile can't nest, a stage started inside another one is not profiled
+        self.active = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # one profiler per crawler, disabled unless PROFILE_ENABLED
+        if getattr(crawler, 'stage_profiler', None) is None:
+            crawler.stage_profiler = cls(
+                enabled=crawler.settings.getbool('PROFILE_ENABLED', False),
+                every=crawler.settings.getint('PROFILE_SAMPLE_EVERY', 1),
+            )
+        return crawler.stage_profiler
+
+    def sample(self, stage):
+        """
+        Count a call of the stage and decide if it is profiled
+        :param stage: the stage name
+        :return: the stage's cProfile.Profile if this call is profiled, else None
+        """
+        if not self.enabled:
+            return None
+        self.calls[stage] += 1
+        if (self.calls[stage] - 1) % self.every:
+            return None
+        self.sampled[stage] += 1
+        if stage not in self.profiles:
+            self.profiles[stage] = cProfile.Profile()
+        return self.profiles[stage]
+
+    @contextmanager
+    def running(self, profile):
+        """
+        Run the block under the profile returned by sample; a no-op for None
+        """
+        if profile is None or self.active:
+            yield
+            return
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler (e.g. an external one) is already active
+            yield
+            return
+        self.active = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.active = False
+
+    @contextmanager
+    def profile(self, stage):
+        with self.running(self.sample(stage)):
+            yield
+
+    def dump(self, directory, prefix):
+        """
+        Write a .pstats and a .collapsed file per profiled stage
+        :param directory: the output directory
+        :param prefix: file name prefix, e.g. the spider name
+        :return: list of the written paths
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for stage, profile in sorted(self.profiles.items()):
+            stats = pstats.Stats(profile)
+            if not stats.stats:
+                continue
+            base = os.path.join(directory, f"{prefix}-{stage.replace('/', '-')}")
+            stats.dump_stats(f'{base}.pstats')
+            with open(f'{base}.collapsed', 'w') as f:
+                for stack, weight in sorted(collapsed_stacks(stats.stats).items()):
+                    f.write(f'{stack} {weight}\n')
+            paths += [f'{base}.pstats', f'{base}.collapsed']
+        return paths
+
+
+def profiled(stage):
+    """
+    Profile a method as the given stage with the instance's profiler (self.profiler)
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.profile(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def frame_label(function):
+    filename, line, name = function
+    if filename == '~':
+        # built-in, e.g. <built-in method builtins.len>
+        return name
+    return f'{os.path.basename(filename)}:{name}:{line}'
+
+
+def collapsed_stacks(stats, max_depth=64, min_microseconds=1):
+    """
+    Convert a cProfile call graph into the collapsed-stack format of flamegraph.pl / speedscope.
+    cProfile keeps caller -> callee edges, not whole stacks, so the self time of a function is split
+    between the paths leading to it in proportion to the time spent along each edge.
+    :param stats: the stats dict of a pstats.Stats
+    :param max_depth: stacks are cut at this depth
+    :param min_microseconds: paths with less time attributed to them are dropped
+    :return: dict of 'root;caller;function' -> self time in microseconds
+    """
+    callees = defaultdict(dict)
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, (_, _, _, edge_time) in callers.items():
+            callees[caller][function] = edge_time
+    roots = [function for function, (_, _, _, _, callers) in stats.items() if not callers]
+    stacks = Counter()
+
+    def walk(function, stack, time):
+        _, _, self_time, total_time, _ = stats[function]
+        share = time / total_time if total_time else 0.0
+        weight = round(self_time * share * 1e6)
+        if weight:
+            stacks[';'.join(frame_label(frame) for frame in stack)] += weight
+        if len(stack) >= max_depth:
+            return
+        for callee, edge_time in callees[function].items():
+            # recursion is folded into the first occurrence
+            if callee in stack or edge_time * share * 1e6 < min_microseconds:
+                continue
+            walk(callee, stack + (callee,), edge_time * share)
+
+    for root in roots:
+        walk(root, (root,), stats[root][3])
+    return dict(stacks)
@@ -0,0 +1,166 @@
+import json
+import re
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, the limiter is then shared between threads only
+    fcntl = None
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter enforcing requests-per-minute and tokens-per-minute together.
+    The bucket state can live in a local file so several crawler processes share one quota;
+    the lock (thread lock plus file lock) is only held to update the state, never while waiting.
+    """
+
+    def __init__(self, requests_per_minute=60, tokens_per_minute=60000, state_path=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.state_path = state_path
+        self.lock = Lock()
+        self.state = self.initial_state()
+
+    def initial_state(self):
+        return {
+            'requests': float(self.requests_per_minute),
+            'tokens': float(self.tokens_per_minute),
+            'updated': time.time(),
+            'blocked_until': 0.0,
+        }
+
+    @contextmanager
+    def locked_state(self):
+        """
+        Hold the locks and yield the current bucket state; changes are written back on exit
+        """
+        with self.lock:
+            if not self.state_path or fcntl is None:
+                yield self.state
+                return
+            with open(self.state_path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or 'null') or self.initial_state()
+                    except ValueError:
+                        state = self.initial_state()
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def refill(self, state, now):
+        elapsed = max(0.0, now - state['updated'])
+        state['requests'] = min(float(self.requests_per_minute),
+                                state['requests'] + elapsed * self.requests_per_minute / 60)
+        state['tokens'] = min(float(self.tokens_per_minute),
+                              state['tokens'] + elapsed * self.tokens_per_minute / 60)
+        state['updated'] = now
+
+    def try_acquire(self, tokens=0):
+        """
+        Take one request and the given number of tokens if they are available
+        :param tokens: estimated tokens for the request
+        :return: 0 if acquired, otherwise the number of seconds to wait before trying again
+        """
+        # a request larger than the whole bucket would never fit, let it through on a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        with self.locked_state() as state:
+            now = time.time()
+            self.refill(state, now)
+            if state['blocked_until'] > now:
+                return state['blocked_until'] - now
+            if state['requests'] >= 1 and state['tokens'] >= tokens:
+                state['requests'] -= 1
+                state['tokens'] -= tokens
+                return 0
+            request_wait = max(0.0, 1 - state['requests']) * 60 / self.requests_per_minute
+            token_wait = max(0.0, tokens - state['tokens']) * 60 / self.tokens_per_minute
+            return max(request_wait, token_wait)
+
+    def acquire(self, tokens=0):
+        """
+        Block until one request and the given number of tokens are available
+        :param tokens: estimated tokens for the request
+        """
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if wait_time <= 0:
+                return
+            time.sleep(wait_time)
+
+    def block_for(self, seconds):
+        """
+        Stop handing out requests for the given number of seconds, e.g. after a 429
+        :param seconds: seconds to wait, usually taken from Retry-After
+        """
+        with self.locked_state() as state:
+            state['blocked_until'] = max(state['blocked_until'], time.time() + seconds)
+
+    def update_from_headers(self, headers):
+        """
+        Adapt the buckets to the x-ratelimit-* and retry-after headers sent by the API
+        :param headers: response headers
+        """
+        if headers is None:
+            return
+        retry_after = self.retry_after(headers)
+        remaining_requests = self.parse_number(headers.get('x-ratelimit-remaining-requests'))
+        remaining_tokens = self.parse_number(headers.get('x-ratelimit-remaining-tokens'))
+        if retry_after is None and (remaining_requests == 0 or remaining_tokens == 0):
+            # the quota is used up, wait for the window the server reports instead of guessing
+            reset_header = 'x-ratelimit-reset-requests' if remaining_requests == 0 else 'x-ratelimit-reset-tokens'
+            retry_after = self.parse_duration(headers.get(reset_header))
+        with self.locked_state() as state:
+            now = time.time()
+            self.refill(state, now)
+            if remaining_requests is not None:
+                state['requests'] = min(state['requests'], remaining_requests)
+            if remaining_tokens is not None:
+                state['tokens'] = min(state['tokens'], remaining_tokens)
+            if retry_after is not None:
+                state['blocked_until'] = max(state['blocked_until'], now + retry_after)
+
+    @classmethod
+    def retry_after(cls, headers):
+        """
+        Read the wait time from the retry-after-ms or retry-after header
+        :param headers: response headers
+        :return: seconds to wait, or None if the headers don't say
+        """
+        retry_after_ms = cls.parse_number(headers.get('retry-after-ms'))
+        if retry_after_ms is not None:
+            return retry_after_ms / 1000
+        return cls.parse_number(headers.get('retry-after'))
+
+    @staticmethod
+    def parse_number(value):
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def parse_duration(value):
+        """
+        Parse durations such as '1s', '6m0s' or '20ms' used by the x-ratelimit-reset-* headers
+        :param value: the header value
+        :return: seconds, or None if the value can't be parsed
+        """
+        if not value:
+            return None
+        parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+        if not parts:
+            return None
+        units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+        return sum(float(number) * units[unit] for number, unit in parts)
@@ -0,0 +1,66 @@
+import logging
+from array import array
+from bisect import bisect_left
+
+import pymongo
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+class ReviewIdSet:
+    """
+    Exact membership set of the stored review ids. Integer ids live in a sorted array (8 bytes each,
+    against ~70 for an int in a set), so millions of them fit in a few tens of MB; ids of other
+    types and the ones added during the crawl go into a plain set.
+    """
+
+    def __init__(self, sorted_ids=(), others=()):
+        self.ids = sorted_ids if isinstance(sorted_ids, array) else array('q', sorted_ids)
+        self.others = set(others)
+
+    @classmethod
+    def from_collection(cls, collection, batch_size=10000):
+        """
+        Load every review_id of the collection, in index order so the array needs no sorting
+        :param collection: the reviews collection
+        :param batch_size: cursor batch size
+        :return: ReviewIdSet
+        """
+        ids, others = array('q'), set()
+        in_order = True
+        # covered by the unique review_id index, the documents themselves are not read
+        cursor = collection.find({}, {'_id': 0, 'review_id': 1}).sort('review_id', pymongo.ASCENDING) \
+            .batch_size(batch_size)
+        for document in cursor:
+            review_id = document.get('review_id')
+            if cls.is_int64(review_id):
+                if ids and review_id < ids[-1]:
+                    in_order = False
+                ids.append(review_id)
+            elif review_id is not None:
+                others.add(review_id)
+        if not in_order:
+            ids = array('q', sorted(ids))
+        review_ids = cls(ids, others)
+        logging.info(f"Loaded {len(review_ids)} known review ids ({review_ids.memory_size() // 1024} KiB)")
+        return review_ids
+
+    @staticmethod
+    def is_int64(value):
+        return isinstance(value, int) and not isinstance(value, bool) and INT64_MIN <= value <= INT64_MAX
+
+    def __contains__(self, review_id):
+        if self.is_int64(review_id):
+            index = bisect_left(self.ids, review_id)
+            if index < len(self.ids) and self.ids[index] == review_id:
+                return True
+        return review_id in self.others
+
+    def add(self, review_id):
+        self.others.add(review_id)
+
+    def __len__(self):
+        return len(self.ids) + len(self.others)
+
+    def memory_size(self):
+        return self.ids.itemsize * len(self.ids)
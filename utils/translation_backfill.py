@@ -0,0 +1,201 @@
+import argparse
+import logging
+import os
+import socket
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+import pymongo.errors
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+from .indexes import ensure_indexes
+from .openAIClient import OpenAiApiClient
+from .rate_limiter import RateLimiter
+from .translation_cache import TranslationCache
+
+LEASE_FIELDS = {'translation_lease': '', 'translation_lease_owner': '', 'translation_lease_expires': ''}
+
+
+class TranslationBackfill:
+    """
+    Translate the stored reviews that are not translated yet, independently of the crawl. Workers
+    lease batches of reviews with a token on the review documents, so several processes can run at
+    once; the reviews of a crashed worker are leased again once the lease expires. A review is written
+    only while the lease is held and only if it is still untranslated, so reruns are harmless.
+
+    Review documents gain: translation_lease, translation_lease_owner, translation_lease_expires
+    (while leased) and translation_attempts.
+    """
+
+    def __init__(self, collection, client, batch_size=20, concurrency=8, lease_seconds=600, max_attempts=3,
+                 worker_id=None):
+        self.collection = collection
+        self.client = client
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.translated = 0
+        self.failed = 0
+
+    @staticmethod
+    def now():
+        return datetime.now(timezone.utc)
+
+    def pending_filter(self, now):
+        return {
+            'translated': {'$ne': True},
+            '$or': [{'translation_lease_expires': {'$exists': False}}, {'translation_lease_expires': {'$lt': now}}],
+            'translation_attempts': {'$not': {'$gte': self.max_attempts}},
+        }
+
+    def claim(self):
+        """
+        Lease up to batch_size untranslated reviews. Candidates are read first and leased with one
+        update_many that checks again that they are free, so only the ones this worker won come back;
+        when other workers won all of them, the next candidates are tried.
+        :return: tuple of (lease token, list of review documents), with no documents only once no
+        review is left to lease
+        """
+        while True:
+            now = self.now()
+            candidates = [document['_id'] for document in
+                          self.collection.find(self.pending_filter(now), {'_id': 1}).limit(self.batch_size)]
+            if not candidates:
+                return None, []
+            token = uuid.uuid4().hex
+            self.collection.update_many(
+                {'_id': {'$in': candidates}, **self.pending_filter(now)},
+                {
+                    '$set': {'translation_lease': token, 'translation_lease_owner': self.worker_id,
+                             'translation_lease_expires': now + timedelta(seconds=self.lease_seconds)},
+                    '$inc': {'translation_attempts': 1},
+                },
+            )
+            reviews = list(self.collection.find({'_id': {'$in': candidates}, 'translation_lease': token},
+                                                {'_id': 1, 'review_id': 1, 'title': 1, 'comment': 1}))
+            if reviews:
+                return token, reviews
+
+    def translate_and_store(self, token, reviews):
+        """
+        Translate the leased reviews and write them back with one bulk_write. The reviews that failed
+        keep their lease until it expires, which spaces out the retries while the API is down; they
+        are given up on after max_attempts
+        :param token: the lease token of the batch
+        :param reviews: the review documents from claim
+        :return: tuple of (translated, failed) counts
+        """
+        try:
+            translations = self.client.translate_reviews_batch([
+                {'review_id': str(review.get('review_id', review['_id'])), 'title': review.get('title'),
+                 'comment': review.get('comment')}
+                for review in reviews
+            ])
+        except Exception as e:
+            logging.error(f"Failed to translate {len(reviews)} reviews: {e}")
+            translations = {}
+        operations = []
+        for review in reviews:
+            translation = translations.get(str(review.get('review_id', review['_id'])))
+            if translation and translation.get('title') is not None and translation.get('comment') is not None:
+                lease = {'_id': review['_id'], 'translation_lease': token, 'translated': {'$ne': True}}
+                operations.append(UpdateOne(lease, {
+                    '$set': {'translated_review_title': translation['title'].strip(),
+                             'translated_review_comment': translation['comment'].strip(), 'translated': True},
+                    '$unset': LEASE_FIELDS,
+                }))
+        if not operations:
+            return 0, len(reviews)
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            logging.error(f"Failed to store {len(e.details.get('writeErrors', []))} of {len(operations)} translations")
+        return len(operations), len(reviews) - len(operations)
+
+    def run(self, limit=None, follow=False, poll_interval=30.0):
+        """
+        Lease and translate batches until no untranslated review is left, keeping at most
+        concurrency batches in flight
+        :param limit: stop after leasing about this many reviews
+        :param follow: keep polling for new reviews instead of stopping
+        :param poll_interval: seconds between polls with follow
+        :return: tuple of (translated, failed) counts
+        """
+        claimed = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = set()
+            while True:
+                while len(in_flight) < self.concurrency and (limit is None or claimed < limit):
+                    token, reviews = self.claim()
+                    if not reviews:
+                        # nothing left to lease, claim retries the batches other workers won
+                        break
+                    claimed += len(reviews)
+                    in_flight.add(executor.submit(self.translate_and_store, token, reviews))
+                if not in_flight:
+                    if follow and (limit is None or claimed < limit):
+                        time.sleep(poll_interval)
+                        continue
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    translated, failed = future.result()
+                    self.translated += translated
+                    self.failed += failed
+                logging.info(f"Translated {self.translated} reviews, {self.failed} failed")
+        return self.translated, self.failed
+
+
+def main():
+    from ..launcher import project_settings
+
+    settings = project_settings()
+    parser = argparse.ArgumentParser(description='Translate the stored reviews that are not translated yet')
+    parser.add_argument('--batch-size', type=int, default=settings.getint('TRANSLATION_BATCH_SIZE', 20),
+                        help='reviews per lease and per translation request')
+    parser.add_argument('--concurrency', type=int, default=settings.getint('TRANSLATION_CONCURRENCY', 8),
+                        help='translation requests in flight')
+    parser.add_argument('--lease', type=int, default=600, help='seconds before the reviews of a stuck worker are freed')
+    parser.add_argument('--max-attempts', type=int, default=3, help='attempts per review before giving up on it')
+    parser.add_argument('--limit', type=int, help='stop after about this many reviews')
+    parser.add_argument('--follow', action='store_true', help='keep polling for newly crawled reviews')
+    parser.add_argument('--poll-interval', type=float, default=30.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    mongo_url = os.getenv('MONGO_URL')
+    if not mongo_url:
+        raise EnvironmentError('MONGO_URL is not set')
+    mongo_client = MongoClient(mongo_url)
+    try:
+        db = mongo_client[os.getenv('MONGO_DB', 'uniqlo')]
+        ensure_indexes(db)
+        client = OpenAiApiClient(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            assistant_id=os.getenv('TRANSLATION_ASSISTANT'),
+            model=os.getenv('TRANSLATION_MODEL', 'gpt-3.5-turbo-1106'),
+            max_batch_tokens=settings.getint('TRANSLATION_BATCH_TOKENS', 3000),
+            cache=TranslationCache(db.translations, max_size=settings.getint('TRANSLATION_CACHE_SIZE', 10000)),
+            # share OPENAI_RATE_LIMIT_FILE with the crawlers to stay within the key's quota together
+            rate_limiter=RateLimiter(
+                requests_per_minute=settings.getint('OPENAI_REQUESTS_PER_MINUTE', 60),
+                tokens_per_minute=settings.getint('OPENAI_TOKENS_PER_MINUTE', 60000),
+                state_path=settings.get('OPENAI_RATE_LIMIT_FILE'),
+            ),
+        )
+        backfill = TranslationBackfill(db.reviews, client, batch_size=args.batch_size, concurrency=args.concurrency,
+                                       lease_seconds=args.lease, max_attempts=args.max_attempts)
+        translated, failed = backfill.run(limit=args.limit, follow=args.follow, poll_interval=args.poll_interval)
+        logging.info(f"Done: {translated} reviews translated, {failed} failed")
+    finally:
+        mongo_client.close()
+
+
+if __name__ == '__main__':
+    main()
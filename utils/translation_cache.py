@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import re
+import unicodedata
+from collections import OrderedDict
+from threading import Lock
+
+import pymongo.errors
+
+
+class TranslationCache:
+    """
+    Content-addressed translation cache: an in-process LRU in front of a Mongo collection.
+    Entries are keyed by a hash of the normalized source text, so repeated and re-crawled
+    text never reaches the API again.
+    """
+
+    def __init__(self, collection=None, max_size=10000):
+        self.collection = collection
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        # the cache is shared by the translation threads
+        self.lock = Lock()
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text):
+        text = unicodedata.normalize('NFKC', text or '')
+        return re.sub(r'\s+', ' ', text).strip()
+
+    @classmethod
+    def make_key(cls, text):
+        return hashlib.sha256(cls.normalize(text).encode('utf-8')).hexdigest()
+
+    def get(self, text):
+        return self.get_many([text]).get(text)
+
+    def get_many(self, texts):
+        """
+        Look up several texts at once, hitting the persistent store with a single query for the LRU misses
+        :param texts: source texts
+        :return: dict of source text -> translation for every text found
+        """
+        found = {}
+        missing = {}
+        with self.lock:
+            for text in texts:
+                key = self.make_key(text)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[text] = self.entries[key]
+                    self.memory_hits += 1
+                else:
+                    missing.setdefault(key, []).append(text)
+
+        if missing and self.collection is not None:
+            stored = {doc['_id']: doc['translation'] for doc in
+                      self.collection.find({'_id': {'$in': list(missing)}}, {'translation': 1})}
+            with self.lock:
+                for key, translation in stored.items():
+                    self._remember(key, translation)
+                    for text in missing.pop(key):
+                        found[text] = translation
+                        self.store_hits += 1
+
+        with self.lock:
+            self.misses += sum(len(texts) for texts in missing.values())
+        return found
+
+    def set(self, text, translation):
+        self.set_many({text: translation})
+
+    def set_many(self, translations):
+        """
+        Store several translations in the LRU and the persistent store
+        :param translations: dict of source text -> translation
+        """
+        entries = {self.make_key(text): translation for text, translation in translations.items() if translation}
+        if not entries:
+            return
+        with self.lock:
+            for key, translation in entries.items():
+                self._remember(key, translation)
+        if self.collection is not None:
+            operations = [pymongo.UpdateOne({'_id': key}, {'$set': {'translation': translation}}, upsert=True)
+                          for key, translation in entries.items()]
+            try:
+                self.collection.bulk_write(operations, ordered=False)
+            except pymongo.errors.PyMongoError as e:
+                # the LRU still has the entries, a failed write only costs a later re-translation
+                logging.warning(f"Failed to store {len(operations)} translations: {e}")
+
+    def _remember(self, key, translation):
+        self.entries[key] = translation
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.memory_hits + self.store_hits,
+                'memory_hits': self.memory_hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+            }
@@ -1,12 +1,51 @@
+import zlib
 from datetime import datetime
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from .price_history import PRICE_HISTORY_COLLECTION
 class Utils:
+    # UNIQLO_API_BASE_URL overrides it, e.g. to point the spiders at the benchmark's stand-in server
+    API_BASE_URL = 'https://www.uniqlo.com/jp/api/commerce/v5/ja'
+
     def __init__(self):
         pass
     @staticmethod
     def get_datetime():
         return int(datetime.now().timestamp())
 
+    @staticmethod
+    def in_shard(key, shard, shards):
+        """
+        Check if a key belongs to the shard; the hash is stable across processes and runs
+        :param key: e.g. a product_id
+        :param shard: index of the shard, from 0 to shards - 1
+        :param shards: the number of shards
+        :return: True if the key belongs to the shard
+        """
+        return shards <= 1 or zlib.crc32(str(key).encode('utf-8')) % shards == shard
+
+    @staticmethod
+    def parse_shard(shard, shards):
+        """
+        Validate the shard and shards spider arguments (-a shard=i -a shards=n)
+        :return: tuple of (shard, shards) as ints
+        """
+        shard, shards = int(shard or 0), int(shards or 1)
+        if shards < 1 or not 0 <= shard < shards:
+            raise ValueError(f'Invalid shard {shard} of {shards}, expected 0 <= shard < shards')
+        return shard, shards
+
+    @staticmethod
+    def review_url(product_id, offset=0, limit=5, base_url=None):
+        """
+        Build the reviews API url for a product page
+        :param product_id: the product id
+        :param offset: offset of the first review on the page
+        :param limit: number of reviews per page
+        :param base_url: the API base url, API_BASE_URL by default
+        :return: the url
+        """
+        return f"{base_url or Utils.API_BASE_URL}/products/{product_id}/reviews?limit={limit}&offset={offset}&sort=submission_time&httpFailure=true"
+
 
 class MongoDBHandler:
     def __init__(self, mongo_url, db_name='uniqlo'):
@@ -17,6 +56,78 @@ class MongoDBHandler:
         start_urls = [collection_name['url'] for collection_name in self.db[collection_name].find({}, {'url': 1}) if 'url' in collection_name]
         return start_urls
 
+    def fetch_review_crawl_plan(self, page_size=5, only_changed=True, collection_name='products',
+                                reviews_collection_name='reviews'):
+        """
+        Build the review crawl plan in one aggregation joining products to their stored review counts
+        :param page_size: reviews per page, used to count the pages to fetch
+        :param only_changed: only return products whose listing review_count exceeds the stored reviews
+        :param collection_name: the name of the products collection
+        :param reviews_collection_name: the name of the reviews collection
+        :return: list of dicts with product_id, url, new_reviews and new_pages, most new reviews first;
+            the endpoint sorts by submission_time, so the new pages are the first ones from offset 0
+        """
+        pipeline = [
+            {'$match': {'review_count': {'$gt': 0}}},
+            {'$project': {'_id': 0, 'product_id': 1, 'url': 1, 'review_count': 1}},
+            {'$lookup': {
+                'from': reviews_collection_name,
+                'let': {'product_id': '$product_id'},
+                'pipeline': [
+                    {'$match': {'$expr': {'$eq': ['$product_id', '$$product_id']}}},
+                    {'$count': 'count'},
+                ],
+                'as': 'stored_reviews',
+            }},
+            {'$addFields': {'stored_count': {'$ifNull': [{'$arrayElemAt': ['$stored_reviews.count', 0]}, 0]}}},
+            {'$addFields': {'new_reviews': {'$subtract': ['$review_count', '$stored_count']} if only_changed
+                            else '$review_count'}},
+            {'$match': {'new_reviews': {'$gt': 0}}},
+            {'$addFields': {'new_pages': {'$ceil': {'$divide': ['$new_reviews', page_size]}}}},
+            {'$project': {'stored_reviews': 0}},
+            {'$sort': {'new_reviews': -1}},
+        ]
+        return list(self.db[collection_name].aggregate(pipeline))
+
+    def fetch_price_history(self, product_id, since=None, collection_name=PRICE_HISTORY_COLLECTION):
+        """
+        Fetch the recorded prices of a product, oldest first
+        :param product_id: the product id
+        :param since: only return prices recorded at or after this datetime
+        :param collection_name: the name of the price history collection
+        :return: list of dicts with date and price
+        """
+        query = {'product_id': product_id}
+        if since is not None:
+            query['date'] = {'$gte': since}
+        return list(self.db[collection_name].find(query, {'_id': 0, 'date': 1, 'price': 1}).sort('date', 1))
+
+    def fetch_latest_price_changes(self, limit=50, collection_name=PRICE_HISTORY_COLLECTION):
+        """
+        Fetch the latest price change of every product whose price changed at least once
+        :param limit: the maximum number of products to return
+        :param collection_name: the name of the price history collection
+        :return: list of dicts with product_id, date, price and previous_price, most recent change first
+        """
+        pipeline = [
+            {'$group': {
+                '_id': '$product_id',
+                'last_two': {'$topN': {'n': 2, 'sortBy': {'date': -1}, 'output': {'date': '$date', 'price': '$price'}}},
+            }},
+            # a product's first observation is its initial price, not a change
+            {'$match': {'last_two.1': {'$exists': True}}},
+            {'$project': {
+                '_id': 0,
+                'product_id': '$_id',
+                'date': {'$arrayElemAt': ['$last_two.date', 0]},
+                'price': {'$arrayElemAt': ['$last_two.price', 0]},
+                'previous_price': {'$arrayElemAt': ['$last_two.price', 1]},
+            }},
+            {'$sort': {'date': -1}},
+            {'$limit': limit},
+        ]
+        return list(self.db[collection_name].aggregate(pipeline))
+
     def close_client(self):
         self.client.close()
 
@@ -58,10 +169,29 @@ class MongoDBHandler:
         reviews_collection = self.db[collection_name]
         return reviews_collection.count_documents({'product_id': product_id})
 
+    def fetch_review_high_water_marks(self, collection_name='products'):
+        """
+        Fetch the newest review already stored for every product
+        :param collection_name: the name of the collection
+        :return: dict of product_id -> {'created_date': ..., 'review_id': ...}
+        """
+        products = self.db[collection_name].find(
+            {'review_high_water_mark': {'$exists': True}},
+            {'product_id': 1, 'review_high_water_mark': 1}
+        )
+        return {product['product_id']: product['review_high_water_mark'] for product in products}
 
-
-
-
-
-
-
+    def save_review_high_water_marks(self, marks, collection_name='products'):
+        """
+        Store the newest crawled review for each product
+        :param marks: dict of product_id -> {'created_date': ..., 'review_id': ...}
+        :param collection_name: the name of the collection
+        """
+        if not marks:
+            return
+        operations = [UpdateOne({'product_id': product_id}, {'$set': {'review_high_water_mark': mark}})
+                      for product_id, mark in marks.items()]
+        self.db[collection_name].bulk_write(operations, ordered=False)
+
+    def clear_review_high_water_marks(self, collection_name='products'):
+        self.db[collection_name].update_many({}, {'$unset': {'review_high_water_mark': ''}})